@@ -1,44 +1,102 @@
+import argparse
+import array
 import base64
+import functools
+import mmap
+import os
 import struct
 import typing
 
-from riff import Riff
-from ico import Ico
+from riff import Chunk, Riff
+from ico import Ico, IcoImage
+import stats
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 
 DEFAULT_DELAY = 1
 
 
 class AniFrame:
-    def __init__(self, ico, post_delay=DEFAULT_DELAY):
+    def __init__(self, ico, post_delay=DEFAULT_DELAY, source_index=None):
         '''
 
         :param ico:
         :param post_delay: in jifies (1/60s)
+        :param source_index: the position of the icon in the fram list, shared by the frames showing the same icon
         '''
         self.ico = ico
         self.post_delay = post_delay
+        self.source_index = source_index
+
+def frames_from_array(frames, delays, indices=None) -> typing.List[AniFrame]:
+    '''
+    The reverse of Ani.to_array, to make gifs of arrays: make_gif(frames_from_array(frames, delays)). Alphas under 128
+    are made transparent, the others opaque.
+
+    :param frames: a (frame count, height, width, 4) uint8 array of RGBA pixels, or with indices, of distinct frames
+    :param delays: of each frame, in jiffies (1/60s)
+    :param indices: the position in frames of each frame to show, frames showing the same one sharing its encoding
+    '''
+    if numpy is None:
+        raise ImportError("frames_from_array needs numpy")
+    frames = numpy.asarray(frames, dtype=numpy.uint8)
+    _, height, width, channels = frames.shape
+    assert channels == 4
+    # packed colors are blue << 24 | green << 16 | red << 8 | alpha, alpha first in memory on little endian machines
+    colors = numpy.ascontiguousarray(frames[..., [3, 0, 1, 2]]).view('<u4').reshape(len(frames), -1)
+    colors = numpy.where(colors & 0xFF < 128, 0, colors | 0xFF).astype(numpy.uint32)
+    icons = [Ico(0, 1, 1, [IcoImage.from_colors(array.array('I', image.tobytes()), width, height)]) for image in colors]
+    if indices is None:
+        indices = range(len(icons))
+    return [AniFrame(icons[index], int(delay), int(index)) for index, delay in zip(indices, delays)]
+
 
 class Ani:
-    def __init__(self, contents: bytes, verbose=False):
-        self.riff = Riff.from_bytes(contents)
-        file_type = self.riff.identifier
+    def __init__(self, contents: typing.Union[bytes, str, os.PathLike], verbose=False, icon_size=None,
+                 icon_bits_per_pixel=None):
+        '''
+        Only the top level chunks are read up front: the lists (INFO, fram) are walked when first needed, and the
+        icons decoded when a frame showing them is.
+
+        :param contents: the ani file contents, or the path of an ani file, which is then memory mapped rather than
+            read so that chunk payloads reference the file pages directly.
+        :param icon_size: for icons holding several images, decode the one closest to this size rather than the first
+            one, see Ico.best_entry
+        :param icon_bits_per_pixel: likewise for the bit depth
+        '''
+        if isinstance(contents, (str, os.PathLike)):
+            with open(contents, "rb") as file:
+                contents = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.contents = contents
+        with stats.timer("riff_parse"):
+            # the top level chunks, lists being left as plain chunks
+            self.header = Riff.from_bytes(contents, nested=False)
+        file_type = self.header.identifier
         assert file_type == b'ACON'
         self.verbose = verbose
+        self.icon_size = icon_size
+        self.icon_bits_per_pixel = icon_bits_per_pixel
+        # the parsed lists by identifier
+        self._lists: typing.Dict[bytes, Riff] = {}
+        # decoded icons by their position in the fram list
+        self._icons: typing.Dict[int, Ico] = {}
         if self.verbose:
-            for chunk in self.riff.subChunks:
-                if chunk.ckID == b'LIST' and chunk.identifier == b"INFO":
-                    for subchunk in chunk.subChunks:
-                        assert subchunk.ckData[-1] == 0
-                        print(f"{subchunk.ckID.decode('latin-1')}: {subchunk.ckData.decode('latin-1')[:-1]}")
+            for chunk in self.header.subChunks:
+                if chunk.ckID == b'LIST':
+                    identifier = bytes(chunk.ckData[:4])
+                    if identifier == b"INFO":
+                        for name, value in self.info.items():
+                            print(f"{name}: {value}")
+                    elif identifier != b"fram":
+                        print(f"Unexpected: {chunk.ckID.decode()}: {identifier} :: {self._list(identifier).subChunks}")
                 elif chunk.ckID == b'anih':
                     print(f"{chunk.ckID.decode()}: {self._parse_anih(chunk.ckData)}")
-                elif chunk.ckID in (b"rate", b"seq "):
-                    pass
-                elif chunk.ckID != b'LIST':
+                elif chunk.ckID not in (b"rate", b"seq "):
                     print(f"Unexpected: {chunk.ckID.decode()}: {base64.b16encode(chunk.ckData)}")
-                elif chunk.identifier != b"fram":
-                    print(f"Unexpected: {chunk.ckID.decode()}: {chunk.identifier} :: {chunk.subChunks}")
 
     @staticmethod
     def _parse_anih(data):
@@ -52,48 +110,228 @@ class Ani:
                 'bits_per_pixel': bits_per_pixel, 'color_planes': color_planes, 'default_rate': default_rate,
                 'format': format, 'seq_present': seq_present, 'remaining_flags': remaining_flags}
 
+    @staticmethod
+    def _parse_dwords(data) -> typing.List[int]:
+        return list(struct.unpack_from(f"<{len(data) // 4}I", data))
+
+    @functools.cached_property
+    def riff(self) -> Riff:
+        '''the whole chunk tree'''
+        return Riff.from_bytes(self.contents)
+
+    def _chunk(self, ckID) -> typing.Optional[Chunk]:
+        for chunk in self.header.subChunks:
+            if chunk.ckID == ckID:
+                return chunk
+        return None
+
+    def _list(self, identifier) -> typing.Optional[Riff]:
+        riff = self._lists.get(identifier)
+        if riff is None:
+            for chunk in self.header.subChunks:
+                if chunk.ckID == b'LIST' and chunk.ckData[:4] == identifier:
+                    riff = self._lists[identifier] = Riff.from_bytes(self.contents, chunk.offset)
+                    break
+        return riff
+
     @property
     def ani_header(self):
-        for chunk in self.riff.subChunks:
-            if chunk.ckID == b'anih':
-                return self._parse_anih(chunk.ckData)
-        return {}
+        chunk = self._chunk(b'anih')
+        return {} if chunk is None else self._parse_anih(chunk.ckData)
 
     @property
-    def frames(self) -> typing.List[AniFrame]:
-        frames = []
-        seq = None
-        rate = None
-        default_rate = DEFAULT_DELAY
-        expecting_seq = False
-        for chunk in self.riff.subChunks:
-            if chunk.ckID == b'anih':
-                anih = self._parse_anih(chunk.ckData)
-                default_rate = anih['default_rate']
-                expecting_seq = anih['seq_present']
-            elif chunk.ckID == b'LIST' and chunk.identifier == b'fram':
-                # process the frames
-                for subChunk in chunk.subChunks:
-                    frames.append(AniFrame(Ico.from_bytes(subChunk.ckData, verbose=self.verbose), default_rate))
-            elif chunk.ckID == b'rate':
-                rate = []
-                for i in range(0, chunk.ckSize, 4):
-                    rate.append(int.from_bytes(chunk.ckData[i:i+4], 'little'))
-            elif chunk.ckID == b'seq ':
-                assert expecting_seq
-                seq = []
-                for i in range(0, chunk.ckSize, 4):
-                    seq.append(int.from_bytes(chunk.ckData[i:i+4], 'little'))
+    def info(self) -> typing.Dict[str, str]:
+        '''the entries of the INFO list (INAM for the title, IART for the author...) by chunk id'''
+        info = self._list(b'INFO')
+        if info is None:
+            return {}
+        return {subchunk.ckID.decode('latin-1'): bytes(subchunk.ckData).rstrip(b'\0').decode('latin-1')
+                for subchunk in info.subChunks}
+
+    @property
+    def icon_count(self) -> int:
+        '''the number of icons in the fram list, counted from their chunk headers'''
+        fram = self._list(b'fram')
+        return 0 if fram is None else len(fram.subChunks)
+
+    @property
+    def frame_count(self) -> int:
+        '''the number of frames shown, without decoding any icon'''
+        return len(self._sequence()[0])
+
+    def _sequence(self) -> typing.Tuple[typing.List[int], typing.List[int]]:
+        '''the icon index and the delay of each frame, in display order'''
+        anih = self.ani_header
+        default_rate = anih.get('default_rate', DEFAULT_DELAY)
+        seq = self._chunk(b'seq ')
         # if a seq was specified, re-arange the frames as defined by it.
         if seq is not None:
-            assert len(seq)
-            raw_frames = frames
-            frames = []
-            for item in seq:
-                frames.append(raw_frames[item])
+            assert anih.get('seq_present', False)
+            icon_indices = self._parse_dwords(seq.ckData)
+            assert len(icon_indices)
         else:
-            assert not expecting_seq
+            assert not anih.get('seq_present', False)
+            icon_indices = list(range(self.icon_count))
+        delays = [default_rate] * len(icon_indices)
+        rate = self._chunk(b'rate')
         if rate is not None:
-            for index, item in enumerate(rate):
-                frames[index].post_delay = item
-        return frames
+            for index, item in enumerate(self._parse_dwords(rate.ckData)[:len(delays)]):
+                delays[index] = item
+        return icon_indices, delays
+
+    def _icon(self, index) -> Ico:
+        ico = self._icons.get(index)
+        if ico is None:
+            chunk = self._list(b'fram').subChunks[index]
+            ico = self._icons[index] = Ico.from_bytes(chunk.ckData, verbose=self.verbose, size=self.icon_size,
+                                                      bits_per_pixel=self.icon_bits_per_pixel)
+        return ico
+
+    def iter_frames(self) -> typing.Iterator[AniFrame]:
+        '''
+        The frames in display order, each icon being decoded when the first frame showing it is reached, and shared
+        by all the frames showing it.
+        '''
+        for index, delay in zip(*self._sequence()):
+            yield AniFrame(self._icon(index), delay, index)
+
+    @property
+    def frames(self) -> typing.List[AniFrame]:
+        '''
+        The frames in display order. Each access returns new AniFrames, but the icons are only decoded once and are
+        shared by all the frames showing them.
+        '''
+        return list(self.iter_frames())
+
+    def rewrite(self, strip_info=False) -> bytes:
+        '''
+        The ani file storing each icon once: byte identical icons of the fram list are merged, those no frame shows
+        dropped, and a seq chunk lists the icon of each frame (unless they are shown in order), anih saying so.
+
+        :param strip_info: also drop the INFO list (title, author...)
+        '''
+        icon_indices, _ = self._sequence()
+        fram = self._list(b'fram')
+        # the new position of the icons, by old position and by contents
+        positions = {}
+        positions_by_data = {}
+        icons = []
+        for index in icon_indices:
+            if index not in positions:
+                chunk = fram.subChunks[index]
+                positions[index] = positions_by_data.setdefault(bytes(chunk.ckData), len(icons))
+                if positions[index] == len(icons):
+                    icons.append(chunk)
+        seq = [positions[index] for index in icon_indices]
+        in_order = seq == list(range(len(icons)))
+
+        chunks = []
+        for chunk in self.header.subChunks:
+            if chunk.ckID == b'LIST' and chunk.ckData[:4] == b'fram':
+                if not in_order:
+                    chunks.append(Chunk.create(b'seq ', struct.pack(f"<{len(seq)}I", *seq)))
+                chunks.append(Riff.create(b'LIST', b'fram', icons))
+            elif chunk.ckID == b'LIST' and chunk.ckData[:4] == b'INFO' and strip_info:
+                continue
+            elif chunk.ckID == b'anih':
+                fields = list(struct.unpack("<IIIIIIIII", chunk.ckData))
+                # frame count, step count and flags
+                fields[1], fields[2] = len(icons), len(seq)
+                fields[8] = fields[8] & ~2 if in_order else fields[8] | 2
+                chunks.append(Chunk.create(b'anih', struct.pack("<IIIIIIIII", *fields)))
+            elif chunk.ckID != b'seq ':
+                chunks.append(chunk)
+        return bytes(Riff.create(self.header.ckID, self.header.identifier, chunks))
+
+    def to_arrays(self):
+        '''
+        The animation as numpy arrays, each icon stored once however many frames show it.
+
+        :return: (icons, indices, delays): a (icon count, height, width, 4) uint8 array of the RGBA pixels of the icons
+            (alpha being 0 or 255, see ico.packed_colors), then the position in icons and the delay in jiffies of each
+            frame, as arrays of frame count integers
+        '''
+        if numpy is None:
+            raise ImportError("to_arrays needs numpy")
+        icon_indices, delays = self._sequence()
+        # only the icons shown, in the order they are first shown
+        positions = {}
+        for index in icon_indices:
+            positions.setdefault(index, len(positions))
+        images = [self._icon(index).images[0] for index in positions]
+        width, height = images[0].bmp_header.width, images[0].bmp_header.height >> 1
+        assert all(image.bmp_header.width == width and image.bmp_header.height >> 1 == height for image in images)
+        colors = numpy.stack([numpy.frombuffer(image.colors, dtype='<u4') for image in images])
+        # packed colors are alpha, red, green, blue in memory on little endian machines
+        icons = colors.view(numpy.uint8).reshape(len(images), height, width, 4)
+        icons = numpy.ascontiguousarray(icons[..., [1, 2, 3, 0]])
+        return icons, numpy.array([positions[index] for index in icon_indices], dtype=numpy.intp), \
+            numpy.array(delays, dtype=numpy.uint32)
+
+    def to_array(self):
+        '''
+        :return: (frames, delays): a (frame count, height, width, 4) uint8 array of the RGBA pixels of the frames, in
+            display order, and their delays in jiffies (1/60s). See to_arrays to share the repeated frames.
+        '''
+        icons, indices, delays = self.to_arrays()
+        return icons[indices], delays
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Rewrite an ani file storing each of its icons once. Without any "
+                                                 "file, checks the rewriting on synthetic ones.")
+    parser.add_argument("ani_file", nargs="?")
+    parser.add_argument("output_file", nargs="?")
+    parser.add_argument("--strip-info", action='store_true', default=False,
+                        help="drop the INFO list (title, author...)")
+
+    args = parser.parse_args()
+
+    if args.ani_file is None:
+        import random
+        from benchmark import synthetic_ico
+
+        test_random = random.Random(0)
+        icon_a, icon_b, icon_c = (Chunk.create(b'icon', bytes(synthetic_ico(8, 8, bits_per_pixel, 4, test_random)))
+                                  for bits_per_pixel in (4, 8, 32))
+
+        def test_ani(icons, seq=None, rates=None):
+            step_count = len(seq) if seq else len(icons)
+            chunks = [Riff.create(b'LIST', b'INFO', [Chunk.create(b'INAM', b'test\0')]),
+                      Chunk.create(b'anih', struct.pack("<IIIIIIIII", 36, len(icons), step_count, 8, 8, 0, 1, 6,
+                                                        1 | (2 if seq else 0)))]
+            if rates:
+                chunks.append(Chunk.create(b'rate', struct.pack(f"<{len(rates)}I", *rates)))
+            if seq:
+                chunks.append(Chunk.create(b'seq ', struct.pack(f"<{len(seq)}I", *seq)))
+            chunks.append(Riff.create(b'LIST', b'fram', icons))
+            return bytes(Riff.create(b'RIFF', b'ACON', chunks))
+
+        def shown(ani):
+            return [(frame.ico.images[0].colors, frame.post_delay) for frame in ani.frames]
+
+        # (contents, icons left, seq written) for duplicated icons shown in order, through a seq, and unused icons
+        for test_contents, test_icon_count, test_seq in (
+                (test_ani([icon_a, icon_b, icon_a, icon_c, icon_b], rates=[1, 2, 3, 4, 5]), 3, [0, 1, 0, 2, 1]),
+                (test_ani([icon_a, icon_b, icon_a, icon_c], seq=[3, 2, 0, 3]), 2, [0, 1, 1, 0]),
+                (test_ani([icon_c, icon_b, icon_a]), 3, None)):
+            test_original = Ani(test_contents)
+            for test_strip_info in (False, True):
+                test_rewritten = Ani(test_original.rewrite(strip_info=test_strip_info))
+                assert shown(test_rewritten) == shown(test_original)
+                assert test_rewritten.icon_count == test_icon_count
+                assert (test_rewritten._chunk(b'seq ') is not None) == (test_seq is not None)
+                assert test_rewritten.ani_header['seq_present'] == (test_seq is not None)
+                assert test_rewritten.ani_header['frame_count'] == test_icon_count
+                if test_seq is not None:
+                    assert test_rewritten._sequence()[0] == test_seq
+                assert (test_rewritten._list(b'INFO') is None) == test_strip_info
+                # rewriting is idempotent
+                assert test_rewritten.rewrite(strip_info=test_strip_info) == bytes(test_rewritten.header)
+    elif args.output_file is None:
+        parser.error("the output file is missing")
+    else:
+        contents = Ani(args.ani_file).rewrite(strip_info=args.strip_info)
+        with open(args.output_file, "wb") as outfile:
+            outfile.write(contents)
@@ -1,16 +1,153 @@
 import argparse
+import array
+import concurrent.futures
+import contextlib
+import inspect
+import json
 import struct
+import sys
 import typing
 
 from ani import Ani, AniFrame
+from cache import DEFAULT_MAX_SIZE, ConversionCache, ImageCache, encoded_images
 from ico import Ico, Color
 import lzw
+import optimize
+from palette import PaletteMapper, build_palette, pack_color, palettize, unpack_color
+import stats
+
+
+# the palette mappers of a worker process, by packed palette
+_worker_mappers = {}
+
+
+def _encode_image(colors, packed_palette, transparency_index, palette_size, lzw_mode):
+    '''
+    The per frame work of make_gif, run in a worker process: palettizes the packed colors of an image and lzw encodes
+    them. The arguments are compact buffers, cheap to send to the worker.
+    '''
+    mapper = _worker_mappers.get(packed_palette)
+    if mapper is None:
+        # consecutive frames of a gif share their palette, only keep the latest one
+        _worker_mappers.clear()
+        mapper = _worker_mappers[packed_palette] = PaletteMapper([unpack_color(color) for color in array.array('I', packed_palette)])
+    return lzw.encode(palettize(colors, None, mapper, transparency_index), palette_size=palette_size, mode=lzw_mode)
+
+
+def _encode_pixels(pixels, palette_size, lzw_mode, image_cache: ImageCache):
+    if image_cache is None:
+        return lzw.encode(pixels, palette_size=palette_size, mode=lzw_mode)
+    key = image_cache.key(pixels, palette_size, lzw_mode)
+    encoded_image = image_cache.get(key)
+    if encoded_image is None:
+        encoded_image = lzw.encode(pixels, palette_size=palette_size, mode=lzw_mode)
+        image_cache.put(key, encoded_image)
+    return encoded_image
+
+
+def _full_frame_images(frames, palette, mapper, executor, width, height, lzw_mode, image_cache):
+    '''(disposal method, rectangle, encoded image or its future) per frame, each frame covering the whole canvas'''
+    rect = optimize.Rect(0, 0, width, height)
+    # the encoded image data of the frames by source_index, as frames showing the same icon encode identically
+    encoded_images = {}
+
+    if executor is not None:
+        # hand every distinct image to the pool up front, the results are then collected in frame order
+        packed_palette = array.array('I', map(pack_color, mapper.palette)).tobytes()
+        futures = []
+        for frame in frames:
+            future = encoded_images.get(frame.source_index)
+            if future is None:
+                image = frame.ico.images[0]
+                if image.is_indexed():
+                    # remapping the indices is cheap, only send the pixels to encode
+                    future = executor.submit(lzw.encode, image.palettize(palette, mapper=mapper),
+                                             palette_size=len(palette), mode=lzw_mode)
+                else:
+                    future = executor.submit(_encode_image, image.colors, packed_palette, len(palette) - 1,
+                                             len(palette), lzw_mode)
+                if frame.source_index is not None:
+                    encoded_images[frame.source_index] = future
+            futures.append(future)
+        for future in futures:
+            yield optimize.RESTORE_BACKGROUND, rect, future
+        return
 
-
-def make_gif(frames: typing.List[AniFrame]):
+    for frame in frames:
+        encoded_image = encoded_images.get(frame.source_index)
+        if encoded_image is None:
+            palettized_frame = frame.ico.images[0].palettize(palette, mapper=mapper)
+
+            encoded_image = _encode_pixels(palettized_frame, len(palette), lzw_mode, image_cache)
+            if frame.source_index is not None:
+                encoded_images[frame.source_index] = encoded_image
+        yield optimize.RESTORE_BACKGROUND, rect, encoded_image
+
+
+def _delta_frame_images(frames, palette, mapper, executor, width, height, lzw_mode, image_cache):
+    '''(disposal method, rectangle, encoded image or its future) per frame, only covering what changes'''
+    # the palettized frames by source_index
+    palettized_frames = {}
+
+    def targets():
+        for frame in frames:
+            palettized_frame = palettized_frames.get(frame.source_index)
+            if palettized_frame is None:
+                image = frame.ico.images[0]
+                palettized_frame = image.palettize(palette, mapper=mapper)
+                if frame.source_index is not None:
+                    palettized_frames[frame.source_index] = palettized_frame
+            yield palettized_frame
+
+    deltas = optimize.delta_frames(targets(), width, height, len(palette) - 1)
+    if executor is not None:
+        # the frames have to be diffed in order, but their encoding can be spread over the pool
+        deltas = [(disposal, rect, executor.submit(lzw.encode, bytes(pixels), palette_size=len(palette), mode=lzw_mode))
+                  for disposal, rect, pixels in deltas]
+        yield from deltas
+        return
+    for disposal, rect, pixels in deltas:
+        yield disposal, rect, _encode_pixels(pixels, len(palette), lzw_mode, image_cache)
+
+
+def build_mapper(frames: typing.Iterable[AniFrame], palette_samples=None) -> PaletteMapper:
+    '''
+    The palette mapper iter_gif uses by default: one palette for the colors of all the frames, leaving room for a
+    transparent one. The lookups are built before iter_gif pads it, so that visible pixels are never matched with the
+    transparent color.
+    '''
+    return PaletteMapper(build_palette((frame.ico.images[0] for frame in frames), 255, max_samples=palette_samples))
+
+
+def iter_gif(frames: typing.Iterable[AniFrame], palette_samples=None, workers=1, delta=False,
+             lzw_mode=lzw.GREEDY, collapse=False, image_cache: ImageCache = None,
+             mapper: PaletteMapper = None) -> typing.Iterator[bytes]:
+    '''
+    Generates the gif as a series of byte strings, each frame's being produced only when the previous ones have been
+    consumed.
+
+    :param frames: AniFrames, e.g. Ani.frames or Ani.iter_frames()
+    :param palette_samples: the number of pixels sampled across all the frames to build the palette, by default all
+        of them. Lower values make the palette quicker to build but less accurate.
+    :param workers: the number of processes palettizing and encoding the frames. The output is the same whatever
+        the number, with 1 the frames are encoded in this process as they are generated.
+    :param delta: only encode the part of each frame that differs from the previous one, see optimize.delta_frames.
+        Smaller and quicker to encode, mostly so for animations where little changes between frames.
+    :param lzw_mode: how hard to compress the frames, see lzw.encode
+    :param collapse: show runs of identical frames as single longer frames, see optimize.collapse_frames
+    :param image_cache: reuse the encoded images it holds for the same pixels, and add the new ones to it. Only
+        consulted when the frames are encoded in this process (workers is 1).
+    :param mapper: maps the colors to its palette instead of one built from the frames (see build_mapper), to share
+        the palette and its lookups between several gifs
+    '''
+    if collapse:
+        frames = optimize.collapse_frames(frames)
+    # the palette is built from all the frames before any is encoded
+    frames = list(frames)
     frame = frames[0]
-    width = frame.ico.images[0].info.width
-    height = frame.ico.images[0].info.height
+    # the directory stores 256 as 0, the bitmap header has the actual size
+    width = frame.ico.images[0].bmp_header.width
+    height = frame.ico.images[0].bmp_header.height >> 1
 
     BITS_PER_PRIMARY_COLOR = 8
     GCT_SIZE_BITS = 8
@@ -19,10 +156,12 @@ def make_gif(frames: typing.List[AniFrame]):
     HAS_GCT = 1
     SORTED = 0
 
-    palette = frame.ico.images[0].posterize(MAX_COLOR)
+    if mapper is None:
+        mapper = build_mapper(frames, palette_samples)
+    palette = list(mapper.palette)
 
     # reduce palette size if input image uses a small number of colors, leaving room for a transparent one.
-    while len(palette)+1 <= (1 << (GCT_SIZE_BITS-1)):
+    while GCT_SIZE_BITS > 1 and len(palette)+1 <= (1 << (GCT_SIZE_BITS-1)):
         GCT_SIZE_BITS -= 1
 
     BACKGROUND_COLOR = MAX_COLOR = (1 << GCT_SIZE_BITS) - 1
@@ -33,9 +172,7 @@ def make_gif(frames: typing.List[AniFrame]):
 
     magic = b'GIF89a'
 
-    output = b''
-
-    output += struct.pack("<6sHHBBB", magic, width, height, HAS_GCT << 7 | (BITS_PER_PRIMARY_COLOR-1) << 4 | SORTED << 3 | (GCT_SIZE_BITS-1), BACKGROUND_COLOR, PIXEL_ASPECT_RATIO_0_0)
+    yield struct.pack("<6sHHBBB", magic, width, height, HAS_GCT << 7 | (BITS_PER_PRIMARY_COLOR-1) << 4 | SORTED << 3 | (GCT_SIZE_BITS-1), BACKGROUND_COLOR, PIXEL_ASPECT_RATIO_0_0)
 
     gct = []
     for i in palette: #frame.images[0].color_map:
@@ -43,7 +180,7 @@ def make_gif(frames: typing.List[AniFrame]):
     for i in range(len(palette), MAX_COLOR + 1):
         gct.append(struct.pack("BBB", 0, 0, 0))
 
-    output += b''.join(gct)
+    yield b''.join(gct)
 
     REPETITIONS = 65535
 
@@ -51,50 +188,142 @@ def make_gif(frames: typing.List[AniFrame]):
 
     gce_ani_ext = struct.pack("<2sB11sBBHB", b'!\xff', 11, b'NETSCAPE2.0', 3, 1, REPETITIONS, BLOCK_END)
 
-    output += gce_ani_ext
+    yield gce_ani_ext
 
-    for frame in frames:
-        TRANSPARENT_BACKGROUND = 1
-        DISPOSAL_METHOD = 2
-        frame_delay_hundredths = int(100*frame.post_delay/60)
-        gce_block_inner = struct.pack('<BHB', DISPOSAL_METHOD << 2 | TRANSPARENT_BACKGROUND, frame_delay_hundredths, MAX_COLOR)
-        gce_block = struct.pack('<2sB%dsB' % len(gce_block_inner), b'!\xf9', len(gce_block_inner), gce_block_inner, 0)
+    executor = concurrent.futures.ProcessPoolExecutor(max_workers=workers) if workers > 1 else None
+    try:
+        if delta:
+            frame_images = _delta_frame_images(frames, palette, mapper, executor, width, height, lzw_mode, image_cache)
+        else:
+            frame_images = _full_frame_images(frames, palette, mapper, executor, width, height, lzw_mode, image_cache)
+        for frame, (disposal_method, rect, encoded_image) in zip(frames, frame_images):
+            TRANSPARENT_BACKGROUND = 1
+            frame_delay_hundredths = min(int(100*frame.post_delay/60), 0xFFFF)
+            gce_block_inner = struct.pack('<BHB', disposal_method << 2 | TRANSPARENT_BACKGROUND, frame_delay_hundredths, MAX_COLOR)
+            gce_block = struct.pack('<2sB%dsB' % len(gce_block_inner), b'!\xf9', len(gce_block_inner), gce_block_inner, 0)
+
+            yield gce_block
+
+            local_color_table_size = 0
+
+            IMAGE_SEPARATOR = 0x2c
 
-        output += gce_block
+            image_descriptor_block = struct.pack('<BHHHHB', IMAGE_SEPARATOR, rect.left, rect.top, rect.width, rect.height, local_color_table_size)
 
-        local_color_table_size = 0
+            yield image_descriptor_block
 
-        IMAGE_SEPARATOR = 0x2c
-        left = top = 0
+            if isinstance(encoded_image, concurrent.futures.Future):
+                encoded_image = encoded_image.result()
+            yield encoded_image
+    finally:
+        if executor is not None:
+            executor.shutdown(cancel_futures=True)
 
-        image_descriptor_block = struct.pack('<BHHHHB', IMAGE_SEPARATOR, left, top, width, height, local_color_table_size)
+    yield b'\x3B'  # EOF
 
-        output += image_descriptor_block
 
-        # TODO: move the mask processing to ICO decoding to turn ICO into RGBA
-        palettized_frame = frame.ico.images[0].palettize(palette, mask=frame.ico.images[0].mask_data)
+def write_gif(frames: typing.Iterable[AniFrame], fileobj: typing.BinaryIO, **options):
+    '''
+    Writes the gif to fileobj as it is being encoded, see iter_gif for the options.
+    '''
+    for data in iter_gif(frames, **options):
+        fileobj.write(data)
 
-        output += lzw.encode(palettized_frame, max_compression_bits=100, palette_size=len(palette))
 
-    output += b'\x3B'  # EOF
-    return output
+def make_gif(frames: typing.Iterable[AniFrame], **options) -> bytes:
+    '''
+    :return: the whole gif, see iter_gif for the options.
+    '''
+    return b''.join(iter_gif(frames, **options))
+
+
+# the options iter_gif defaults, spelled out in the cache keys so that passing them or not makes the same key
+_ITER_GIF_DEFAULTS = {name: parameter.default for name, parameter in inspect.signature(iter_gif).parameters.items()
+                      if parameter.default is not inspect.Parameter.empty}
+
+
+def convert(ani: Ani, cache: ConversionCache = None, **options) -> bytes:
+    '''
+    make_gif of the frames of ani. With a cache, a gif previously made from the same contents with the same options is
+    returned as is, and new ones are encoded through the image cache of the process, shared by all its conversions.
+    The options must then be json serializable, but for a mapper, which is keyed by its palette.
+    '''
+    if cache is None:
+        return make_gif(ani.frames, **options)
+    key_options = {**_ITER_GIF_DEFAULTS, **options, "icon_size": ani.icon_size,
+                   "icon_bits_per_pixel": ani.icon_bits_per_pixel}
+    if key_options["mapper"] is not None:
+        key_options["mapper"] = [pack_color(color) for color in key_options["mapper"].palette]
+    key = cache.key(ani.contents, key_options)
+    gif = cache.get(key)
+    if gif is None:
+        options.setdefault("image_cache", encoded_images)
+        gif = make_gif(ani.frames, **options)
+        cache.put(key, gif)
+    return gif
 
 
 if __name__ == "__main__":
 
     parser = argparse.ArgumentParser()
     parser.add_argument("ani_file")
-    parser.add_argument("output_file")
+    parser.add_argument("output_file", nargs="?", help="'-' for standard output")
     parser.add_argument("-v", "--verbose", action='store_true', default=False)
+    parser.add_argument("--info", action='store_true', default=False,
+                        help="print the ani header, INFO entries and frame count as json instead of converting, "
+                             "without decoding any icon")
+    parser.add_argument("--icon-size", type=int, default=None,
+                        help="for icons holding several images, use the one closest to this size rather than the first")
+    parser.add_argument("--icon-bpp", type=int, default=None,
+                        help="for icons holding several images, use the one closest to this bit depth (by default the "
+                             "deepest of those closest to --icon-size)")
+    parser.add_argument("--palette-samples", type=int, default=None,
+                        help="build the palette from about this many pixels rather than all of them")
+    parser.add_argument("-j", "--jobs", type=int, default=1, help="encode the frames with this many processes")
+    parser.add_argument("--delta", action='store_true', default=False,
+                        help="only encode the changing part of each frame")
+    parser.add_argument("--lzw-mode", choices=lzw.MODES, default=lzw.GREEDY,
+                        help="fast: quickest but largest, greedy: dictionary compression, "
+                             "auto: whichever suits each frame")
+    parser.add_argument("--collapse", action='store_true', default=False,
+                        help="show runs of identical frames as single longer frames")
+
+    parser.add_argument("--cache", metavar="DIRECTORY",
+                        help="reuse the gifs converted from the same file with the same options, kept in this directory")
+    parser.add_argument("--cache-size", type=int, default=DEFAULT_MAX_SIZE >> 20,
+                        help="the size the cache is trimmed to, in MiB")
+    parser.add_argument("--stats", nargs="?", const="table", choices=("table", "json"),
+                        help="print how long each stage took and what it processed to stderr")
+    parser.add_argument("--trace-memory", action='store_true', default=False,
+                        help="with --stats, also measure the peak memory use (slower)")
 
     args = parser.parse_args()
 
-    with open(args.ani_file, "rb") as file:
-        contents = file.read()
-
-    ani = Ani(contents, verbose=args.verbose)
-
-    # now convert to gif
-    with open(args.output_file, "wb") as outfile:
-        outfile.write(make_gif(ani.frames))
-
+    if args.info:
+        ani = Ani(args.ani_file)
+        print(json.dumps({"header": ani.ani_header, "info": ani.info, "icon_count": ani.icon_count,
+                          "frame_count": ani.frame_count}, indent=2))
+        sys.exit()
+    if args.output_file is None:
+        parser.error("the output_file argument is required")
+
+    with contextlib.ExitStack() as stack:
+        if args.stats:
+            collected_stats = stack.enter_context(stats.collect(trace_memory=args.trace_memory))
+
+        ani = Ani(args.ani_file, verbose=args.verbose, icon_size=args.icon_size, icon_bits_per_pixel=args.icon_bpp)
+
+        # now convert to gif
+        options = dict(palette_samples=args.palette_samples, workers=args.jobs, delta=args.delta,
+                       lzw_mode=args.lzw_mode, collapse=args.collapse)
+        if args.output_file == "-":
+            outfile = sys.stdout.buffer
+        else:
+            outfile = stack.enter_context(open(args.output_file, "wb"))
+        if args.cache:
+            outfile.write(convert(ani, ConversionCache(args.cache, args.cache_size << 20), **options))
+        else:
+            write_gif(ani.frames, outfile, **options)
+
+    if args.stats:
+        print(collected_stats.to_json() if args.stats == "json" else collected_stats.format_table(), file=sys.stderr)
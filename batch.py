@@ -0,0 +1,196 @@
+import argparse
+import concurrent.futures
+import glob
+import itertools
+import os
+import sys
+import traceback
+import typing
+
+from ani import Ani
+from ani2gif import convert, write_gif
+from cache import DEFAULT_MAX_SIZE, ConversionCache
+import lzw
+
+
+ANI_EXTENSION = ".ani"
+GIF_EXTENSION = ".gif"
+
+
+class BatchResult(typing.NamedTuple):
+    ani_path: str
+    gif_path: str
+    # 'converted', 'skipped' (the gif is up to date) or 'failed'
+    status: str
+    error: typing.Optional[str] = None
+
+
+def _glob_root(pattern):
+    # the leading directories of the pattern without wildcards, which the matches are mirrored relative to
+    parts = os.path.normpath(pattern).split(os.sep)
+    return os.sep.join(itertools.takewhile(lambda part: not glob.has_magic(part), parts[:-1]))
+
+
+def find_inputs(inputs: typing.Iterable[str]) -> typing.Iterator[typing.Tuple[str, str]]:
+    '''
+    Expands directories (searched recursively for .ani files), glob patterns and plain file paths. Plain files are
+    mirrored relative to the deepest directory holding all of them, so that files of the same name in different
+    directories keep apart.
+
+    :return: (ani path, path of the ani relative to the tree it is mirrored from) pairs
+    '''
+    inputs = list(inputs)
+    files = [item for item in inputs if not os.path.isdir(item) and not glob.has_magic(item)]
+    files_root = os.path.commonpath([os.path.dirname(os.path.abspath(item)) for item in files]) if files else None
+    for item in inputs:
+        if os.path.isdir(item):
+            for directory, subdirectories, files in os.walk(item):
+                subdirectories.sort()
+                for name in sorted(files):
+                    if name.lower().endswith(ANI_EXTENSION):
+                        path = os.path.join(directory, name)
+                        yield path, os.path.relpath(path, item)
+        elif glob.has_magic(item):
+            root = _glob_root(item)
+            for path in sorted(glob.glob(item, recursive=True)):
+                if os.path.isfile(path):
+                    yield path, os.path.relpath(path, root or os.curdir)
+        else:
+            yield item, os.path.relpath(os.path.abspath(item), files_root)
+
+
+def read_manifest(manifest_path) -> typing.List[str]:
+    '''the inputs listed in a manifest file, one file, directory or glob pattern per line, # starting comments'''
+    with open(manifest_path) as manifest:
+        lines = (line.split("#", 1)[0].strip() for line in manifest)
+        return [line for line in lines if line]
+
+
+def convert_file(ani_path, gif_path, cache: ConversionCache = None, **options):
+    '''
+    Converts a single file, see ani2gif.iter_gif for the options and ani2gif.convert for the cache. The gif only
+    appears once it is complete.
+    '''
+    ani = Ani(ani_path)
+    os.makedirs(os.path.dirname(gif_path) or os.curdir, exist_ok=True)
+    temporary_path = gif_path + ".tmp"
+    try:
+        with open(temporary_path, "wb") as outfile:
+            if cache is not None:
+                outfile.write(convert(ani, cache, **options))
+            else:
+                write_gif(ani.frames, outfile, **options)
+        os.replace(temporary_path, gif_path)
+    except BaseException:
+        if os.path.exists(temporary_path):
+            os.remove(temporary_path)
+        raise
+
+
+def _convert_task(ani_path, gif_path, options) -> BatchResult:
+    try:
+        convert_file(ani_path, gif_path, **options)
+    except Exception as e:
+        return BatchResult(ani_path, gif_path, "failed", traceback.format_exception_only(type(e), e)[-1].strip())
+    return BatchResult(ani_path, gif_path, "converted")
+
+
+def _convert_files(files, jobs, force, options) -> typing.Iterator[BatchResult]:
+    tasks = []
+    for ani_path, gif_path in files:
+        if not force and os.path.exists(gif_path) and os.path.exists(ani_path) and \
+                os.path.getmtime(gif_path) >= os.path.getmtime(ani_path):
+            yield BatchResult(ani_path, gif_path, "skipped")
+            continue
+        if jobs <= 1:
+            yield _convert_task(ani_path, gif_path, options)
+            continue
+        tasks.append((ani_path, gif_path))
+    if not tasks:
+        return
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as executor:
+        task_iter = iter(tasks)
+        pending = set()
+        while True:
+            for ani_path, gif_path in task_iter:
+                pending.add(executor.submit(_convert_task, ani_path, gif_path, options))
+                if len(pending) >= 2 * jobs:
+                    break
+            if not pending:
+                break
+            done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                yield future.result()
+
+
+def convert_batch(inputs: typing.Iterable[str], output_dir, jobs=1, force=False, **options) -> typing.Iterator[BatchResult]:
+    '''
+    Converts every ani found in inputs (see find_inputs) into output_dir, mirroring the directory layout they were
+    found in. Gifs newer than their ani are skipped unless force is set, and a failing file does not stop the others.
+    Inputs that would be written to the same gif (e.g. two listed files of the same name) raise a ValueError, before
+    anything is converted.
+
+    :param jobs: the number of worker processes, each running whole conversions. At most twice as many files are
+        queued to them at a time.
+    :param options: passed to convert_file
+    :return: one result per file, in completion order
+    '''
+    files = []
+    sources = {}
+    for ani_path, relative_path in find_inputs(inputs):
+        gif_path = os.path.join(output_dir, os.path.splitext(relative_path)[0] + GIF_EXTENSION)
+        key = os.path.normcase(os.path.abspath(gif_path))
+        source = sources.get(key)
+        if source is None:
+            sources[key] = ani_path
+            files.append((ani_path, gif_path))
+        elif os.path.abspath(source) != os.path.abspath(ani_path):
+            raise ValueError(f"{source} and {ani_path} would both be written to {gif_path}")
+    return _convert_files(files, jobs, force, options)
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Convert many ani files to gifs, mirroring their directory layout.")
+    parser.add_argument("output_dir")
+    parser.add_argument("inputs", nargs="*", help="ani files, directories to search for them, or glob patterns")
+    parser.add_argument("-m", "--manifest", help="a file listing more inputs, one per line")
+    parser.add_argument("-j", "--jobs", type=int, default=os.cpu_count(), help="the number of worker processes")
+    parser.add_argument("-f", "--force", action='store_true', default=False,
+                        help="convert even the files whose gif is newer than them")
+    parser.add_argument("-v", "--verbose", action='store_true', default=False, help="also list the converted files")
+    parser.add_argument("--palette-samples", type=int, default=None,
+                        help="build the palette from about this many pixels rather than all of them")
+    parser.add_argument("--lzw-mode", choices=lzw.MODES, default=lzw.GREEDY,
+                        help="fast: quickest but largest, greedy: dictionary compression, "
+                             "auto: whichever suits each frame")
+    parser.add_argument("--collapse", action='store_true', default=False,
+                        help="show runs of identical frames as single longer frames")
+    parser.add_argument("--cache", metavar="DIRECTORY",
+                        help="reuse the gifs converted from the same file with the same options, kept in this directory")
+    parser.add_argument("--cache-size", type=int, default=DEFAULT_MAX_SIZE >> 20,
+                        help="the size the cache is trimmed to, in MiB")
+
+    args = parser.parse_args()
+
+    inputs = list(args.inputs)
+    if args.manifest:
+        inputs.extend(read_manifest(args.manifest))
+
+    cache = ConversionCache(args.cache, args.cache_size << 20) if args.cache else None
+
+    counts = {"converted": 0, "skipped": 0, "failed": 0}
+    try:
+        results = convert_batch(inputs, args.output_dir, jobs=args.jobs, force=args.force, cache=cache,
+                                palette_samples=args.palette_samples, lzw_mode=args.lzw_mode, collapse=args.collapse)
+    except ValueError as e:
+        parser.error(str(e))
+    for result in results:
+        counts[result.status] += 1
+        if result.status == "failed":
+            print(f"{result.ani_path}: {result.error}", file=sys.stderr)
+        elif args.verbose:
+            print(f"{result.ani_path}: {result.status} {result.gif_path}", file=sys.stderr)
+    print(", ".join(f"{count} {status}" for status, count in counts.items()), file=sys.stderr)
+    sys.exit(1 if counts["failed"] else 0)
@@ -0,0 +1,169 @@
+import argparse
+import array
+import json
+import os
+import platform
+import random
+import struct
+import time
+import typing
+
+from ani import Ani
+from ani2gif import make_gif
+from bmp import BitmapInfoHeader, Color
+from ico import Ico, IcoImage, IcoImageInfo
+import ico
+import lzw
+from palette import PaletteMapper, build_palette
+from riff import Chunk, Riff
+
+
+STAGES = ("riff_parse", "ico_decode", "posterize", "palette", "palettize", "lzw", "make_gif")
+
+
+class Case(typing.NamedTuple):
+    width: int = 32
+    height: int = 32
+    frame_count: int = 8
+    bits_per_pixel: int = 32
+    # the number of distinct colors per frame
+    colors: int = 16
+    seq: bool = False
+    rate: bool = False
+
+    @property
+    def name(self):
+        return f"{self.width}x{self.height}_{self.bits_per_pixel}bpp_{self.frame_count}f_{self.colors}c" + \
+            ("_seq" if self.seq else "") + ("_rate" if self.rate else "")
+
+
+def synthetic_ico(width, height, bits_per_pixel, colors, rnd: random.Random) -> Ico:
+    '''
+    A cursor made of 4x4 blocks of random colors inside a disc, transparent outside of it.
+    '''
+    if bits_per_pixel <= 8:
+        color_map = [Color(rnd.randrange(256), rnd.randrange(256), rnd.randrange(256)) for _ in range(1 << bits_per_pixel)]
+        values = list(range(min(colors, len(color_map))))
+    else:
+        color_map = []
+        values = [rnd.randrange(1 << 24) for _ in range(colors)]
+    blocks = [[rnd.choice(values) for _ in range((width + 3) // 4)] for _ in range((height + 3) // 4)]
+    image_data = array.array('B' if bits_per_pixel <= 8 else 'I')
+    mask_data = array.array('B')
+    radius = min(width, height) / 2
+    for y in range(height):
+        for x in range(width):
+            transparent = (x + 0.5 - width / 2) ** 2 + (y + 0.5 - height / 2) ** 2 > radius ** 2
+            value = blocks[y // 4][x // 4]
+            if bits_per_pixel == 32:
+                # blue, green, red, alpha
+                value = value << 8 | (0 if transparent else 0xFF)
+            image_data.append(value)
+            mask_data.append(1 if transparent else 0)
+    info = IcoImageInfo(width & 0xFF, height & 0xFF, len(color_map) & 0xFF, 0, 1, bits_per_pixel, 0, 0)
+    bmp_header = BitmapInfoHeader(40, width, height * 2, 1, bits_per_pixel, 0, 0, 0, 0, 0, 0)
+    return Ico(0, 1, 1, [IcoImage.from_pixels(info, bmp_header, color_map, image_data, mask_data)])
+
+
+def synthetic_ani(case: Case, seed=0) -> bytes:
+    rnd = random.Random(seed)
+    icons = [synthetic_ico(case.width, case.height, case.bits_per_pixel, case.colors, rnd)
+             for _ in range(case.frame_count)]
+    # back and forth through the icons
+    seq = list(range(case.frame_count)) + list(range(case.frame_count - 2, 0, -1)) if case.seq else None
+    step_count = len(seq) if seq else case.frame_count
+    flags = 1 | (2 if seq else 0)
+    chunks = [
+        Riff.create(b'LIST', b'INFO', [Chunk.create(b'INAM', f"{case.name}\0".encode()),
+                                       Chunk.create(b'IART', b'benchmark\0')]),
+        Chunk.create(b'anih', struct.pack("<IIIIIIIII", 36, case.frame_count, step_count, case.width, case.height,
+                                          case.bits_per_pixel, 1, 6, flags)),
+    ]
+    if case.rate:
+        chunks.append(Chunk.create(b'rate', b''.join(struct.pack("<I", rnd.randrange(2, 10))
+                                                     for _ in range(step_count))))
+    if seq:
+        chunks.append(Chunk.create(b'seq ', b''.join(struct.pack("<I", item) for item in seq)))
+    chunks.append(Riff.create(b'LIST', b'fram', [Chunk.create(b'icon', bytes(icon)) for icon in icons]))
+    return bytes(Riff.create(b'RIFF', b'ACON', chunks))
+
+
+def _timed(function, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def run_case(case: Case, repeat=3) -> typing.Dict[str, float]:
+    '''the best of repeat timings of each stage of the conversion, in seconds'''
+    data = synthetic_ani(case)
+    timings = {}
+    timings["riff_parse"], riff = _timed(lambda: Riff.from_bytes(data), repeat)
+    fram = [chunk for chunk in riff.subChunks if chunk.ckID == b'LIST' and chunk.identifier == b'fram'][0]
+    timings["ico_decode"], icons = _timed(lambda: [Ico.from_bytes(chunk.ckData) for chunk in fram.subChunks], repeat)
+    images = [icon.images[0] for icon in icons]
+    timings["posterize"], _ = _timed(lambda: [image.posterize(255) for image in images], repeat)
+    timings["palette"], palette = _timed(lambda: build_palette(images, 255), repeat)
+    palette = palette + [Color(0, 0, 0, 0)] * (256 - len(palette))
+    # a new mapper each time, its cache would make later runs quicker
+    timings["palettize"], pixels = _timed(lambda: [image.palettize(palette, mapper=PaletteMapper(palette[:-1]))
+                                                   for image in images], repeat)
+    timings["lzw"], _ = _timed(lambda: [lzw.encode(frame, palette_size=len(palette)) for frame in pixels], repeat)
+    frames = Ani(data).frames
+    # iter_gif assembles each frame as it is encoded, so this is the whole conversion of the decoded frames, of which
+    # the assembly is what the stages above leave out
+    timings["make_gif"], _ = _timed(lambda: make_gif(frames), repeat)
+    return timings
+
+
+def _print_table(results, baseline=None):
+    print(f"{'case':32}" + "".join(f"{stage:>12}" for stage in STAGES))
+    for name, timings in results.items():
+        print(f"{name:32}" + "".join(f"{timings[stage] * 1000:10.2f}ms" for stage in STAGES))
+        if baseline and name in baseline:
+            print(f"{'  vs baseline':32}" + "".join(f"{timings[stage] / baseline[name][stage]:11.2f}x"
+                                                   if baseline[name].get(stage) else f"{'-':>12}"
+                                                   for stage in STAGES))
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Time each stage of the conversion of synthetic ani files.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[32, 64])
+    parser.add_argument("--bpp", type=int, nargs="+", default=[1, 4, 8, 24, 32])
+    parser.add_argument("--frames", type=int, default=8)
+    parser.add_argument("--colors", type=int, default=16, help="distinct colors per frame")
+    parser.add_argument("--seq", action='store_true', default=False, help="add a seq chunk")
+    parser.add_argument("--rate", action='store_true', default=False, help="add a rate chunk")
+    parser.add_argument("--repeat", type=int, default=3, help="keep the best of this many runs of each stage")
+    parser.add_argument("-o", "--output", help="save the results as json")
+    parser.add_argument("--baseline", help="json results of a previous run to compare with")
+    parser.add_argument("--write-samples", metavar="DIR", help="also write the generated ani files to DIR")
+
+    args = parser.parse_args()
+
+    cases = [Case(size, size, args.frames, bits_per_pixel, args.colors, args.seq, args.rate)
+             for size in args.sizes for bits_per_pixel in args.bpp]
+
+    if args.write_samples:
+        os.makedirs(args.write_samples, exist_ok=True)
+        for case in cases:
+            with open(os.path.join(args.write_samples, case.name + ".ani"), "wb") as sample:
+                sample.write(synthetic_ani(case))
+
+    results = {case.name: run_case(case, repeat=args.repeat) for case in cases}
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            baseline = json.load(baseline_file)["results"]
+    _print_table(results, baseline)
+
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump({"python": platform.python_version(), "numpy": ico.numpy is not None, "repeat": args.repeat,
+                       "results": results}, output, indent=2)
@@ -1,39 +1,122 @@
+import itertools
+
+
+def _unpack_table(bits):
+    # for each byte value, the values of the fields of the given width it holds, most significant first
+    mask = (1 << bits) - 1
+    return [tuple((byte >> shift) & mask for shift in range(8 - bits, -1, -bits)) for byte in range(256)]
+
+
+_UNPACK_TABLES = {bits: _unpack_table(bits) for bits in (1, 2, 4)}
+
+
 class Bitstream:
+    '''
+    Reads fields most significant bit first (as BMP pixel rows are stored) and writes them least significant bit first
+    (as GIF LZW codes are stored). Both directions go through an integer bit accumulator, so the underlying buffer is
+    never sliced or copied per call.
+    '''
     def __init__(self, buffer):
-        self.buffer = buffer
-        self.remainder = 8 if len(buffer) else 0
-        self.remainder_end = 0
+        self._data = memoryview(buffer).cast('B') if len(buffer) else memoryview(b'')
+        self._pos = 0
+        self._out = None
+        self._acc = 0
+        self._acc_bits = 0
+
+    def _output(self):
+        # only a stream that gets written to needs its own mutable copy of the buffer
+        if self._out is None:
+            self._out = bytearray(self._data)
+        return self._out
+
+    @property
+    def buffer(self):
+        '''the bytes written so far, including the partially filled last byte'''
+        self._output()
+        if self._acc_bits:
+            return bytes(self._out) + bytes((self._acc,))
+        return bytes(self._out)
 
     def pop_bits(self, bits):
-        result = 0
-        while bits >= self.remainder:
-            result = result << self.remainder
-            result += self.buffer[0] & (0xFF >> (8-self.remainder))
-            bits -= self.remainder
-            self.remainder = 8
-            self.buffer = self.buffer[1:]
-        if bits:
-            result = result << bits
-            result += (self.buffer[0] & (0xFF >> (8-self.remainder))) >> (self.remainder - bits)
-            self.remainder -= bits
-        return result
+        acc = self._acc
+        acc_bits = self._acc_bits
+        while acc_bits < bits:
+            acc = acc << 8 | self._data[self._pos]
+            self._pos += 1
+            acc_bits += 8
+        acc_bits -= bits
+        self._acc = acc & ((1 << acc_bits) - 1)
+        self._acc_bits = acc_bits
+        return acc >> acc_bits
+
+    def pop_many(self, bits, count):
+        '''pops count fields of the given width, returning them as a list'''
+        if self._acc_bits == 0:
+            data = self._data
+            pos = self._pos
+            if bits % 8 == 0:
+                width = bits >> 3
+                end = pos + width * count
+                if end > len(data):
+                    raise IndexError("pop past the end of the bitstream")
+                self._pos = end
+                if width == 1:
+                    return list(data[pos:end])
+                return [int.from_bytes(data[i:i+width], 'big') for i in range(pos, end, width)]
+            if bits in _UNPACK_TABLES:
+                whole_bytes = bits * count >> 3
+                if pos + whole_bytes > len(data):
+                    raise IndexError("pop past the end of the bitstream")
+                self._pos = pos + whole_bytes
+                result = list(itertools.chain.from_iterable(map(_UNPACK_TABLES[bits].__getitem__,
+                                                                data[pos:pos + whole_bytes])))
+                for _ in range(count - len(result)):
+                    result.append(self.pop_bits(bits))
+                return result
+        return [self.pop_bits(bits) for _ in range(count)]
 
     def push_bits(self, number: int, bits: int):
         assert number < (1 << bits)
-        # push the number as needed
-        number = number << self.remainder_end
-        total_bits = self.remainder_end + bits
-        raw_bytes = number.to_bytes((total_bits + 7) // 8, "little")
-        if self.remainder_end:
-            self.buffer = self.buffer[:-1] + (self.buffer[-1] | raw_bytes[0]).to_bytes(1, 'little')
-            raw_bytes = raw_bytes[1:]
-        self.buffer += raw_bytes
-        self.remainder_end = (total_bits) % 8
+        acc = self._acc | number << self._acc_bits
+        acc_bits = self._acc_bits + bits
+        if acc_bits >= 8:
+            out = self._output()
+            while acc_bits >= 8:
+                out.append(acc & 0xFF)
+                acc >>= 8
+                acc_bits -= 8
+        self._acc = acc
+        self._acc_bits = acc_bits
+
+    def push_many(self, codes, widths):
+        '''
+        pushes every code in codes.
+
+        :param widths: either the bit width shared by all the codes, or an iterable of one width per code
+        '''
+        if isinstance(widths, int):
+            widths = itertools.repeat(widths)
+        out = self._output()
+        acc = self._acc
+        acc_bits = self._acc_bits
+        for number, bits in zip(codes, widths):
+            assert number < (1 << bits)
+            acc |= number << acc_bits
+            acc_bits += bits
+            if acc_bits >= 32:
+                out += (acc & 0xFFFFFFFF).to_bytes(4, 'little')
+                acc >>= 32
+                acc_bits -= 32
+        while acc_bits >= 8:
+            out.append(acc & 0xFF)
+            acc >>= 8
+            acc_bits -= 8
+        self._acc = acc
+        self._acc_bits = acc_bits
 
     def remaining_buffer(self):
-        if self.remainder < 8:
-            return self.buffer[1:]
-        return self.buffer
+        '''the unread bytes, dropping what is left of a partially read byte'''
+        return self._data[self._pos:]
 
 
 if __name__ == "__main__":
@@ -50,3 +133,23 @@ if __name__ == "__main__":
     assert testbs.buffer == b'\x2F'
     testbs.push_bits(2,2)
     assert testbs.buffer == b'\xAF'
+
+    testbs = Bitstream(b'')
+    testbs.push_many([1, 1, 1, 1, 2, 2, 0x1ff, 0x3], [1, 1, 1, 1, 2, 2, 9, 7])
+    assert testbs.buffer == b'\xAF\xff\x07'
+    testbs.push_many([5] * 5, 3)
+    assert testbs.buffer == b'\xAF\xff\x07\x6d\x5b'
+
+    testbs = Bitstream(b'\xA5\x0F\xF0\x12\x34')
+    assert testbs.pop_bits(1) == 1
+    assert testbs.pop_bits(3) == 2
+    assert testbs.pop_many(4, 3) == [5, 0, 15]
+    assert testbs.pop_many(8, 1) == [0xF0]
+    assert bytes(testbs.remaining_buffer()) == b'\x12\x34'
+    assert testbs.pop_many(16, 1) == [0x1234]
+
+    testbs = Bitstream(bytes(range(16)))
+    assert testbs.pop_many(1, 12) == [0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0]
+    assert bytes(testbs.remaining_buffer()) == bytes(range(2, 16))
+    assert testbs.pop_many(2, 4) == [0, 1, 0, 0]
+    assert testbs.pop_many(24, 2) == [0x203040, 0x506070]
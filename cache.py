@@ -0,0 +1,172 @@
+import collections
+import dataclasses
+import hashlib
+import json
+import os
+import tempfile
+import typing
+
+import stats
+
+
+# bump when the encoder output changes, so that gifs made by older versions are not served anymore
+FORMAT_VERSION = 1
+# options not changing the gif, left out of the keys
+NEUTRAL_OPTIONS = ("workers", "image_cache")
+GIF_SUFFIX = ".gif"
+
+DEFAULT_MAX_SIZE = 256 << 20
+DEFAULT_IMAGE_CACHE_SIZE = 64 << 20
+# eviction trims the cache to this fraction of its max size, so that the next ones are many puts away
+EVICTION_TARGET = 0.9
+# puts after which the directory is scanned again anyway, to account for what other processes added or evicted
+RESCAN_INTERVAL = 1000
+
+
+@dataclasses.dataclass
+class _DirectoryUsage:
+    # the size of the gifs as of the last scan, plus those put since
+    size: int
+    puts_since_scan: int = 0
+
+
+# by cache directory, in this process. Kept outside the caches, which are pickled to worker processes afresh for
+# every conversion.
+_usages: typing.Dict[str, _DirectoryUsage] = {}
+
+
+class ConversionCache:
+    '''
+    An on-disk cache of converted gifs, keyed by a hash of the ani contents and of the conversion options. Past
+    max_size bytes, the least recently used gifs are evicted down to EVICTION_TARGET of it, recency being tracked with
+    their modification times. The size is tracked as gifs are put, the directory is only scanned when that estimate
+    passes max_size, or every RESCAN_INTERVAL puts.
+
+    Several processes can share the directory: entries are written to a temporary file first, then renamed.
+    '''
+    def __init__(self, directory, max_size=DEFAULT_MAX_SIZE):
+        self.directory = directory
+        self.max_size = max_size
+        os.makedirs(directory, exist_ok=True)
+
+    @staticmethod
+    def key(contents, options: typing.Mapping[str, typing.Any]) -> str:
+        '''
+        :param contents: the ani file contents, any buffer (bytes, mmap...)
+        :param options: the conversion options, see ani2gif.iter_gif. Besides NEUTRAL_OPTIONS, they must be json
+            serializable.
+        '''
+        digest = hashlib.sha256(contents)
+        options = {name: value for name, value in options.items() if name not in NEUTRAL_OPTIONS}
+        try:
+            encoded_options = json.dumps([FORMAT_VERSION, sorted(options.items())])
+        except TypeError as e:
+            # the repr of an object is no key, it would differ from one process or run to the next
+            raise TypeError(f"conversion options must be json serializable to be cached: {e}") from None
+        digest.update(encoded_options.encode())
+        return digest.hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + GIF_SUFFIX)
+
+    def get(self, key) -> typing.Optional[bytes]:
+        path = self._path(key)
+        try:
+            with open(path, "rb") as file:
+                data = file.read()
+            os.utime(path)
+        except FileNotFoundError:
+            # missing, or evicted by another process meanwhile
+            stats.count("conversion_cache_misses")
+            return None
+        stats.count("conversion_cache_hits")
+        return data
+
+    def put(self, key, data: bytes):
+        path = self._path(key)
+        descriptor, temporary_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        try:
+            with os.fdopen(descriptor, "wb") as file:
+                file.write(data)
+            try:
+                replaced_size = os.stat(path).st_size
+            except FileNotFoundError:
+                replaced_size = 0
+            os.replace(temporary_path, path)
+        except BaseException:
+            os.remove(temporary_path)
+            raise
+        usage = _usages.get(os.path.abspath(self.directory))
+        if usage is None or usage.puts_since_scan + 1 >= RESCAN_INTERVAL:
+            self.evict()
+            return
+        usage.size += len(data) - replaced_size
+        usage.puts_since_scan += 1
+        if usage.size > self.max_size:
+            self.evict()
+
+    def evict(self):
+        '''
+        Scans the directory and, if the cache does not fit in max_size, removes the least recently used gifs until it
+        fits in EVICTION_TARGET of it.
+        '''
+        entries = []
+        with os.scandir(self.directory) as scan:
+            for entry in scan:
+                if entry.name.endswith(GIF_SUFFIX):
+                    try:
+                        status = entry.stat()
+                    except FileNotFoundError:
+                        continue
+                    entries.append((status.st_mtime_ns, status.st_size, entry.path))
+        size = sum(entry[1] for entry in entries)
+        if size > self.max_size:
+            entries.sort()
+            for _, entry_size, path in entries:
+                if size <= self.max_size * EVICTION_TARGET:
+                    break
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                size -= entry_size
+        _usages[os.path.abspath(self.directory)] = _DirectoryUsage(size)
+
+
+class ImageCache:
+    '''
+    An in-memory cache of lzw encoded images, keyed by a hash of their palettized pixels, palette size (the only part
+    of the palette the encoding depends on) and lzw mode, so that the icons shared by different files are only compressed
+    once per process. Past max_size bytes of encoded data, the least recently used images are dropped.
+    '''
+    def __init__(self, max_size=DEFAULT_IMAGE_CACHE_SIZE):
+        self.max_size = max_size
+        self.size = 0
+        self._images: typing.OrderedDict[typing.Tuple[bytes, int, str], bytes] = collections.OrderedDict()
+
+    @staticmethod
+    def key(pixels: typing.Sequence[int], palette_size, lzw_mode) -> typing.Tuple[bytes, int, str]:
+        return hashlib.blake2b(bytes(pixels), digest_size=16).digest(), palette_size, lzw_mode
+
+    def get(self, key) -> typing.Optional[bytes]:
+        encoded_image = self._images.get(key)
+        if encoded_image is None:
+            stats.count("image_cache_misses")
+            return None
+        self._images.move_to_end(key)
+        stats.count("image_cache_hits")
+        return encoded_image
+
+    def put(self, key, encoded_image: bytes):
+        previous = self._images.pop(key, None)
+        if previous is not None:
+            self.size -= len(previous)
+        self._images[key] = encoded_image
+        self.size += len(encoded_image)
+        while self.size > self.max_size:
+            _, dropped = self._images.popitem(last=False)
+            self.size -= len(dropped)
+
+
+# the image cache of this process, shared by all its conversions
+encoded_images = ImageCache()
@@ -0,0 +1,135 @@
+import argparse
+import typing
+
+from ani import Ani, AniFrame
+from ani2gif import build_mapper, make_gif
+from cache import ImageCache
+from ico import Ico
+import lzw
+
+
+class OutputSpec(typing.NamedTuple):
+    '''one of the gifs make_gifs renders from the same frames'''
+    # the frames are downscaled by this integer factor
+    scale: int = 1
+    # the positions of the frames to keep, all of them by default
+    frames: typing.Optional[typing.Sequence[int]] = None
+    lzw_mode: str = lzw.GREEDY
+    delta: bool = False
+    collapse: bool = False
+
+    @classmethod
+    def parse(cls, text) -> 'OutputSpec':
+        '''
+        Reads comma separated options: scale=2, frames=0 (or 0-3, or 0;2;5), lzw=fast, delta, collapse.
+        '''
+        spec = cls()
+        for option in filter(None, text.split(",")):
+            name, _, value = option.partition("=")
+            if name == "scale":
+                if int(value) < 1:
+                    raise ValueError(f"scale must be at least 1, not {value}")
+                spec = spec._replace(scale=int(value))
+            elif name == "frames":
+                frames = []
+                for part in value.split(";"):
+                    first, _, last = part.partition("-")
+                    first, last = int(first), int(last or first)
+                    if last < first:
+                        raise ValueError(f"empty frame range {part!r}")
+                    frames.extend(range(first, last + 1))
+                spec = spec._replace(frames=frames)
+            elif name == "lzw":
+                if value not in lzw.MODES:
+                    raise ValueError(f"unknown lzw mode {value!r}, expected one of {lzw.MODES}")
+                spec = spec._replace(lzw_mode=value)
+            elif name in ("delta", "collapse"):
+                spec = spec._replace(**{name: True})
+            else:
+                raise ValueError(f"unknown output option {name!r}")
+        return spec
+
+
+def _scaled_frames(frames: typing.List[AniFrame], scale, scaled_icons) -> typing.List[AniFrame]:
+    if scale == 1:
+        return frames
+    scaled_frames = []
+    for frame in frames:
+        # frames showing the same icon share its downscaled copy
+        key = scale, frame.source_index if frame.source_index is not None else id(frame.ico)
+        ico = scaled_icons.get(key)
+        if ico is None:
+            ico = scaled_icons[key] = Ico(0, 1, 1, [frame.ico.images[0].downscale(scale)])
+        scaled_frames.append(AniFrame(ico, frame.post_delay, frame.source_index))
+    return scaled_frames
+
+
+def make_gifs(frames: typing.Iterable[AniFrame], specs: typing.Iterable[OutputSpec], palette_samples=None,
+              workers=1) -> typing.Iterator[bytes]:
+    '''
+    Renders several gifs of the same frames, which are only decoded once. The palette is built once from the full
+    size frames and shared by every gif, as are its lookups and the encoded images (when two gifs have the same
+    pixels in a frame, at the same lzw mode).
+
+    :param specs: one per gif, rendered in order. A ValueError is raised before any is rendered if one keeps frames
+        past the end of the animation, or none, or has a scale under 1.
+    :param palette_samples: see ani2gif.iter_gif
+    :param workers: see ani2gif.iter_gif
+    :return: the gifs, in the order of specs
+    '''
+    frames = list(frames)
+    specs = list(specs)
+    for spec in specs:
+        if spec.frames is not None and not all(0 <= index < len(frames) for index in spec.frames):
+            raise ValueError(f"frames {spec.frames} out of range, there are {len(frames)} frames")
+        if spec.frames == [] or spec.scale < 1:
+            raise ValueError(f"invalid output {spec}: no frames, or a scale under 1")
+    mapper = build_mapper(frames, palette_samples)
+    image_cache = ImageCache()
+    scaled_icons = {}
+    for spec in specs:
+        spec_frames = frames if spec.frames is None else [frames[index] for index in spec.frames]
+        yield make_gif(_scaled_frames(spec_frames, spec.scale, scaled_icons), workers=workers, delta=spec.delta,
+                       lzw_mode=spec.lzw_mode, collapse=spec.collapse, image_cache=image_cache, mapper=mapper)
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Convert an ani to several gifs, decoding it only once.")
+    parser.add_argument("ani_file")
+    parser.add_argument("outputs", nargs="+", metavar="OUTPUT_FILE[:OPTIONS]",
+                        help="a gif to write, followed by its comma separated options: scale=N to downscale the "
+                             "frames N times, frames=0 (or 0-3, or 0;2;5) to only keep some frames, lzw=fast|greedy|"
+                             "auto, delta, collapse. For instance full.gif thumbnail.gif:scale=2 still.gif:frames=0. "
+                             "The options follow the last colon: end paths containing colons with one.")
+    parser.add_argument("--palette-samples", type=int, default=None,
+                        help="build the palette from about this many pixels rather than all of them")
+    parser.add_argument("-j", "--jobs", type=int, default=1, help="encode the frames with this many processes")
+    parser.add_argument("--icon-size", type=int, default=None,
+                        help="for icons holding several images, use the one closest to this size rather than the first")
+    parser.add_argument("--icon-bpp", type=int, default=None,
+                        help="for icons holding several images, use the one closest to this bit depth")
+
+    args = parser.parse_args()
+
+    paths = []
+    specs = []
+    for output in args.outputs:
+        path, colon, options = output.rpartition(":")
+        if not colon:
+            path, options = output, ""
+        try:
+            specs.append(OutputSpec.parse(options))
+        except ValueError as e:
+            parser.error(f"{output}: {e}")
+        paths.append(path)
+
+    ani = Ani(args.ani_file, icon_size=args.icon_size, icon_bits_per_pixel=args.icon_bpp)
+    for output, spec in zip(args.outputs, specs):
+        if spec.frames is not None and max(spec.frames) >= ani.frame_count:
+            parser.error(f"{output}: frame {max(spec.frames)} out of range, {args.ani_file} has {ani.frame_count} "
+                         f"frames")
+    for path, gif in zip(paths, make_gifs(ani.iter_frames(), specs, palette_samples=args.palette_samples,
+                                          workers=args.jobs)):
+        with open(path, "wb") as outfile:
+            outfile.write(gif)
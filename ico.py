@@ -1,8 +1,231 @@
+import array
+import dataclasses
 import struct
 import typing
 
 from bitstream import Bitstream
 from bmp import BitmapInfoHeader, Color
+from palette import PaletteMapper, pack_color, palettize
+import stats
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+def _decode_rows_python(data, width, height, bits_per_pixel):
+    rows = []
+    bitstream = Bitstream(data)
+    for i in range(height):
+        row = bitstream.pop_many(bits_per_pixel, width)
+        excess_bits = (32 - ((width * bits_per_pixel) % 32)) & 31
+        # rows always round to nearest 4 bytes
+        if excess_bits:
+            bitstream.pop_bits(excess_bits)
+        rows.append(row)
+    remainder = bitstream.remaining_buffer()
+    rows.reverse()
+    pixels = array.array('B' if bits_per_pixel <= 8 else 'I')
+    for row in rows:
+        pixels.extend(row)
+    return pixels, remainder
+
+
+def _decode_rows_numpy(data, width, height, bits_per_pixel):
+    # rows always round to nearest 4 bytes
+    stride = ((width * bits_per_pixel + 31) // 32) * 4
+    # bitmaps are stored bottom-up
+    rows = numpy.frombuffer(data, dtype=numpy.uint8, count=stride * height).reshape(height, stride)[::-1]
+    if bits_per_pixel < 8:
+        bits = numpy.unpackbits(rows, axis=1)
+        if bits_per_pixel == 1:
+            pixels = bits[:, :width]
+        else:
+            weights = 1 << numpy.arange(bits_per_pixel - 1, -1, -1, dtype=numpy.uint8)
+            fields = bits[:, :width * bits_per_pixel].reshape(height, width, bits_per_pixel)
+            pixels = fields @ weights
+    elif bits_per_pixel == 8:
+        pixels = rows[:, :width]
+    else:
+        # multi byte pixels are read as big endian numbers, as the bitstream would
+        bytes_per_pixel = bits_per_pixel // 8
+        channels = rows[:, :width * bytes_per_pixel].reshape(height, width, bytes_per_pixel).astype(numpy.uint32)
+        pixels = numpy.zeros((height, width), dtype=numpy.uint32)
+        for channel in range(bytes_per_pixel):
+            pixels = pixels << 8 | channels[:, :, channel]
+    if bits_per_pixel <= 8:
+        pixels = array.array('B', pixels.astype(numpy.uint8).tobytes())
+    else:
+        pixels = array.array('I', pixels.astype(numpy.uint32).tobytes())
+    return pixels, memoryview(data)[stride * height:]
+
+
+def decode_rows(data, width, height, bits_per_pixel):
+    '''
+    Decodes a bottom-up bitmap with 4 byte aligned rows into a flat top-down array of pixel values, of bytes up to
+    8 bits per pixel, using numpy when it is installed.
+
+    :return: the pixels and the data following the bitmap
+    '''
+    if numpy is not None and bits_per_pixel in (1, 2, 4, 8, 24, 32):
+        return _decode_rows_numpy(data, width, height, bits_per_pixel)
+    return _decode_rows_python(data, width, height, bits_per_pixel)
+
+
+def encode_rows(pixels, width, height, bits_per_pixel) -> bytes:
+    '''the inverse of decode_rows: bottom-up rows, padded to 4 bytes'''
+    stride = ((width * bits_per_pixel + 31) // 32) * 4
+    padding_bits = stride * 8 - width * bits_per_pixel
+    rows = []
+    for y in range(height):
+        row = 0
+        for pixel in pixels[y*width:(y+1)*width]:
+            row = row << bits_per_pixel | pixel
+        rows.append((row << padding_bits).to_bytes(stride, 'big'))
+    rows.reverse()
+    return b''.join(rows)
+
+
+def _packed_colors_python(image_data, mask_data, color_map, bits_per_pixel):
+    if bits_per_pixel <= 8:
+        colors = map([pack_color(color) | 0xFF for color in color_map].__getitem__, image_data)
+    elif bits_per_pixel == 24:
+        colors = (pixel << 8 | 0xFF for pixel in image_data)
+    elif bits_per_pixel == 32:
+        colors = (0 if pixel & 0xFF < 128 else pixel | 0xFF for pixel in image_data)
+    else:
+        raise Exception
+    if mask_data is None:
+        return array.array('I', colors)
+    return array.array('I', (0 if masked == 1 else color for color, masked in zip(colors, mask_data)))
+
+
+def _packed_colors_numpy(image_data, mask_data, color_map, bits_per_pixel):
+    if bits_per_pixel <= 8:
+        table = numpy.array([pack_color(color) | 0xFF for color in color_map], dtype=numpy.uint32)
+        colors = table[numpy.frombuffer(image_data, dtype=numpy.uint8)]
+    else:
+        pixels = numpy.frombuffer(image_data, dtype=numpy.uint32)
+        if bits_per_pixel == 24:
+            colors = pixels << 8 | 0xFF
+        else:
+            colors = numpy.where(pixels & 0xFF < 128, 0, pixels | 0xFF).astype(numpy.uint32)
+    if mask_data is not None:
+        colors[numpy.frombuffer(mask_data, dtype=numpy.uint8) == 1] = 0
+    return array.array('I', colors.tobytes())
+
+
+def packed_colors(image_data, mask_data, color_map, bits_per_pixel) -> array.array:
+    '''
+    The pixels as packed colors (see palette.pack_color) with the palette and mask applied: the pixels masked out or
+    with an alpha under 128 are 0, the others opaque. mask_data may be None, as for 32bpp images.
+    '''
+    if numpy is not None and bits_per_pixel in (1, 2, 4, 8, 24, 32) and isinstance(image_data, array.array) and \
+            (mask_data is None or isinstance(mask_data, (bytes, array.array))):
+        return _packed_colors_numpy(image_data, mask_data, color_map, bits_per_pixel)
+    return _packed_colors_python(image_data, mask_data, color_map, bits_per_pixel)
+
+
+def _remap_indices_python(image_data, mask_data, table, transparency_index):
+    pixels = bytes(image_data).translate(table)
+    if any(mask_data):
+        pixels = bytes(transparency_index if masked == 1 else pixel for pixel, masked in zip(pixels, mask_data))
+    return pixels
+
+
+def _remap_indices_numpy(image_data, mask_data, table, transparency_index):
+    # the second half of the table is for the masked pixels
+    table = numpy.frombuffer(table + bytes([transparency_index]) * 256, dtype=numpy.uint8)
+    keys = numpy.frombuffer(image_data, dtype=numpy.uint8) | numpy.frombuffer(mask_data, dtype=numpy.uint8).astype(
+        numpy.uint16) << 8
+    return table[keys].tobytes()
+
+
+@stats.timed("palettize")
+def remap_indices(image_data, mask_data, color_map, mapper: PaletteMapper, transparency_index) -> bytes:
+    '''
+    Palettizes an image of up to 8 bits per pixel as palette.palettize would its colors, looking up each entry of
+    its color map once rather than each pixel: the pixel values are then translated through the resulting table.
+    The palette cache hits and misses it counts are these lookups, one per color map entry the image uses.
+
+    :param image_data: the pixel values, indices into color_map
+    :param mask_data: one 0 or 1 per pixel, the pixels with a 1 becoming transparency_index
+    '''
+    # the entries of the color map the image uses, as packed_colors shows them, values past its end being transparent
+    table = bytearray([transparency_index]) * 256
+    hits = misses = 0
+    for value in set(bytes(image_data)):
+        if value < len(color_map):
+            color = pack_color(color_map[value]) | 0xFF
+            palette_index = mapper.cache.get(color)
+            if palette_index is None:
+                palette_index = mapper.lookup(color)
+                misses += 1
+            else:
+                hits += 1
+            table[value] = palette_index
+    table = bytes(table)
+    if stats.current() is not None:
+        stats.count("palette_cache_hits", hits)
+        stats.count("palette_cache_misses", misses)
+    if numpy is not None and isinstance(image_data, array.array) and isinstance(mask_data, (bytes, array.array)):
+        return _remap_indices_numpy(image_data, mask_data, table, transparency_index)
+    return _remap_indices_python(image_data, mask_data, table, transparency_index)
+
+
+def _downscale_python(colors, width, height, factor):
+    new_width, new_height = -(-width // factor), -(-height // factor)
+    scaled = array.array('I', bytes(4 * new_width * new_height))
+    for new_y in range(new_height):
+        rows = range(new_y * factor, min((new_y + 1) * factor, height))
+        for new_x in range(new_width):
+            area = visible = blue = green = red = 0
+            for y in rows:
+                for color in colors[y*width + new_x*factor:y*width + min((new_x + 1) * factor, width)]:
+                    area += 1
+                    if color:
+                        visible += 1
+                        blue += color >> 24
+                        green += color >> 16 & 0xFF
+                        red += color >> 8 & 0xFF
+            if 2 * visible >= area:
+                half = visible // 2
+                scaled[new_y*new_width + new_x] = (blue + half) // visible << 24 | (green + half) // visible << 16 | \
+                    (red + half) // visible << 8 | 0xFF
+    return scaled
+
+
+def _downscale_numpy(colors, width, height, factor):
+    new_width, new_height = -(-width // factor), -(-height // factor)
+    # pad to whole boxes with pixels that count neither as visible nor in the area
+    padded = numpy.zeros((new_height * factor, new_width * factor), dtype=numpy.uint32)
+    padded[:height, :width] = numpy.frombuffer(colors, dtype=numpy.uint32).reshape(height, width)
+    inside = numpy.zeros(padded.shape, dtype=numpy.uint32)
+    inside[:height, :width] = 1
+
+    def box_sums(values):
+        return values.reshape(new_height, factor, new_width, factor).sum(axis=(1, 3), dtype=numpy.uint64)
+
+    area = box_sums(inside)
+    visible = box_sums((padded != 0).astype(numpy.uint32))
+    shown = 2 * visible >= area
+    divisor = numpy.maximum(visible, 1)
+    scaled = numpy.full(area.shape, 0xFF, dtype=numpy.uint64)
+    for shift in (24, 16, 8):
+        scaled |= (box_sums(padded >> shift & 0xFF) + divisor // 2) // divisor << shift
+    return array.array('I', numpy.where(shown, scaled, 0).astype(numpy.uint32).tobytes())
+
+
+def downscale(colors, width, height, factor) -> array.array:
+    '''
+    Box filters packed colors (see packed_colors) down by an integer factor, the last row and column of boxes being
+    partial when the size is not a multiple of it. A box is visible when at least half its pixels are, with their
+    average color.
+    '''
+    if numpy is not None:
+        return _downscale_numpy(colors, width, height, factor)
+    return _downscale_python(colors, width, height, factor)
 
 
 class IcoImageInfo(typing.NamedTuple):
@@ -25,79 +248,117 @@ class IcoImageInfo(typing.NamedTuple):
         return cls(*fields)
 
 
-class IcoImage(typing.NamedTuple):
+class _IcoImageFields(typing.NamedTuple):
     info: IcoImageInfo
     bmp_header: BitmapInfoHeader
     color_map: typing.List[Color]
-    image_data: typing.List[int]
-    mask_data: typing.List[int]
+    # the pixel values as stored, palette indices up to 8 bits per pixel. Decoded 32bpp images keep their colors
+    # instead, alpha normalized as in packed_colors
+    image_data: typing.Sequence[int]
+    # one 0 or 1 per pixel, 1 for the pixels masked out. None for 32bpp images, their alpha channel replacing it
+    mask_data: typing.Optional[typing.Sequence[int]]
+    # the pixels as they are shown, see packed_colors
+    colors: typing.Optional[array.array] = None
+
+
+class IcoImage(_IcoImageFields):
+    '''
+    An image of an ico file. Its colors are computed from its pixel values when they are not given.
+    '''
+    __slots__ = ()
+
+    def __new__(cls, info, bmp_header, color_map, image_data, mask_data, colors=None):
+        if colors is None:
+            colors = packed_colors(image_data, mask_data, color_map, bmp_header.bits_per_pixel)
+        return super().__new__(cls, info, bmp_header, color_map, image_data, mask_data, colors)
+
+    @classmethod
+    def from_pixels(cls, info, bmp_header, color_map, image_data, mask_data):
+        '''computes the colors of the image from its pixel values'''
+        return cls(info, bmp_header, color_map, image_data, mask_data)
+
+    def __bytes__(self):
+        '''the bitmap, as stored at info.data_offset'''
+        height = self.bmp_header.height >> 1
+        # the color table stores RGB0
+        color_map = [dataclasses.replace(color, alpha=0) for color in self.color_map]
+        mask_data = self.mask_data if self.mask_data is not None else bytes(len(self.image_data))
+        return b''.join([bytes(self.bmp_header)] + [bytes(color) for color in color_map] +
+                        [encode_rows(self.image_data, self.bmp_header.width, height, self.bmp_header.bits_per_pixel),
+                         encode_rows(mask_data, self.bmp_header.width, height, 1)])
 
+    @stats.timed("posterize")
     def posterize(self, color_count, alpha_bits=1):
         if len(self.color_map) and color_count >= len(self.color_map):
             return self.color_map
+        # reducing the bit depth only needs the distinct colors, transparent ones all being 0
+        colors = set(self.colors)
         for i in range(8):
             palette = set()
-            for index, j in enumerate(self.image_data):
-                if self.bmp_header.bits_per_pixel <= 8:
-                    r,g,b,a = self.color_map[j].values()
-                elif self.bmp_header.bits_per_pixel == 24:
-                    r,g,b = struct.unpack("BBB", j.to_bytes(3, 'big'))
-                    a = 255
-                elif self.bmp_header.bits_per_pixel == 32:
-                    r,g,b,a = struct.unpack("BBBB", j.to_bytes(4, 'big'))
-                else:
-                    raise NotImplemented
-
-                r = r >> i
-                g = g >> i
-                b = b >> i
-                if (a < 128) or (self.mask_data[index] == 1):
+            for color in colors:
+                b, g, r, a = color >> 24, color >> 16 & 0xFF, color >> 8 & 0xFF, color & 0xFF
+                if a < 128:
                     # is transparent, so make it a consistent shade
-                    r = g = b = 0
-                    a = 0
+                    palette.add((0, 0, 0, 0))
                 else:
-                    a = a >> max(i, 8-alpha_bits)
-                palette.add((r,g,b,a))
+                    palette.add((b >> i, g >> i, r >> i, a >> max(i, 8-alpha_bits)))
                 if len(palette) > color_count:
                     break
             if len(palette) <= color_count:
                 new_color_map = []
-                for r, g, b, a in palette:
-                    new_color_map.append(Color(r << i, g << i, b << i, a << max(i, 8-alpha_bits)))
+                for b, g, r, a in palette:
+                    new_color_map.append(Color(b << i, g << i, r << i, a << max(i, 8-alpha_bits)))
                 return new_color_map
 
-    def palettize(self, new_color_map, transparency_index=-1, mask=None):
+    @classmethod
+    def from_colors(cls, colors: array.array, width, height) -> 'IcoImage':
+        '''a 32bpp image of packed colors, which must already be normalized as packed_colors does'''
+        info = IcoImageInfo(width & 0xFF, height & 0xFF, 0, 0, 1, 32, 0, 0)
+        bmp_header = BitmapInfoHeader(40, width, height * 2, 1, 32, 0, 0, 0, 0, 0, 0)
+        # 32bpp pixels are stored as packed colors, the alpha channel replacing the mask
+        return cls(info, bmp_header, [], colors, None, colors)
+
+    def downscale(self, factor) -> 'IcoImage':
+        '''a 32bpp copy of the image, downscaled by an integer factor (see downscale)'''
+        width, height = self.bmp_header.width, self.bmp_header.height >> 1
+        return IcoImage.from_colors(downscale(self.colors, width, height, factor), -(-width // factor),
+                                    -(-height // factor))
+
+    def is_indexed(self) -> bool:
+        '''whether the pixel values are indices into the color map, which palettize then maps instead of the pixels'''
+        return self.bmp_header.bits_per_pixel <= 8 and len(self.color_map) > 0
+
+    def packed_pixels(self) -> typing.Iterable[int]:
+        '''the pixels as packed colors, see packed_colors'''
+        return self.colors
+
+    def palettize(self, new_color_map, transparency_index=-1, mask=None, mapper: PaletteMapper = None):
+        '''
+        :param mask: an extra mask, the image's own being already applied to its colors
+        :param mapper: a PaletteMapper of new_color_map, to reuse its cached lookups across images
+        '''
         if transparency_index == -1:
             transparency_index = len(new_color_map) - 1
-        pixels = []
-        for index, i in enumerate(self.image_data):
-            if self.bmp_header.bits_per_pixel <= 8:
-                color = self.color_map[i]
-            elif self.bmp_header.bits_per_pixel == 32:
-                color = Color(*struct.unpack("BBBB", i.to_bytes(4, 'big')))
-            elif self.bmp_header.bits_per_pixel == 24:
-                color = Color(*struct.unpack("BBB", i.to_bytes(3, 'big')))
-            else:
-                raise Exception
-            if color.alpha < 128 or mask and mask[index] == 1:
-                pixels.append(transparency_index)
-            elif color in new_color_map:
-                pixels.append(new_color_map.index(color))
-            else:
-                # find nearest
-                best = 0
-                margin = 1000
-                for index, palette_color in enumerate(new_color_map):
-                    new_margin = max(max(color.red, palette_color.red)-min(color.red, palette_color.red),
-                                 max(color.green, palette_color.green)-min(color.green, palette_color.green),
-                                 max(color.blue, palette_color.blue)-min(color.blue, palette_color.blue),
-                                 #max(color.alpha, palette_color.alpha)-min(color.alpha, palette_color.alpha)
-                                     )
-                    if new_margin < margin:
-                        margin = new_margin
-                        best = index
-                pixels.append(best)
-        return pixels
+        if mapper is None:
+            mapper = PaletteMapper(new_color_map)
+        if self.is_indexed() and mask is None:
+            return remap_indices(self.image_data, self.mask_data, self.color_map, mapper, transparency_index)
+        return palettize(self.colors, mask, mapper, transparency_index)
+
+
+class IcoEntry(typing.NamedTuple):
+    '''what the directory and the bitmap header say of an image, read without decoding it'''
+    index: int
+    width: int
+    height: int
+    bits_per_pixel: int
+    # png compressed images are listed but can not be decoded
+    png: bool
+
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+# channels per png color type
+PNG_CHANNELS = {0: 1, 2: 3, 3: 1, 4: 2, 6: 4}
 
 
 class Ico(typing.NamedTuple):
@@ -107,72 +368,153 @@ class Ico(typing.NamedTuple):
     images: typing.List[IcoImage]
 
     def __bytes__(self):
-        return struct.pack(f"HHH", self.reserved, self.image_type, self.image_count)
+        '''the whole ico file, with the directory entries pointing at the bitmaps as they are laid out'''
+        bitmaps = [bytes(image) for image in self.images]
+        directory = []
+        offset = 6 + 16 * len(self.images)
+        for image, bitmap in zip(self.images, bitmaps):
+            directory.append(bytes(image.info._replace(data_size=len(bitmap), data_offset=offset)))
+            offset += len(bitmap)
+        return b''.join([struct.pack("<HHH", self.reserved, self.image_type, len(self.images))] + directory + bitmaps)
+
+    @staticmethod
+    def directory(data) -> typing.List[IcoImageInfo]:
+        _, _, image_count = struct.unpack_from("<HHH", data)
+        return [IcoImageInfo.from_bytes(data[6+16*index:6+16*index+16]) for index in range(image_count)]
 
     @classmethod
-    def from_bytes(cls, data, verbose=False):
-        reserved, image_type, image_count = struct.unpack("<HHH", data[:6])
-        images = []
-        images_data = data[6:]
-        for _ in range(image_count):
-            image_info = IcoImageInfo.from_bytes(images_data)
-            bmp_header = BitmapInfoHeader.from_bytes(data[image_info.data_offset:image_info.data_offset+40])
-            # now repeat with the deciphered size
-            bmp_header = BitmapInfoHeader.from_bytes(data[image_info.data_offset:image_info.data_offset+bmp_header.header_size])
-            remainder = data[image_info.data_offset+bmp_header.header_size:image_info.data_offset+image_info.data_size]
-            color_map = []
-            if bmp_header.bits_per_pixel <= 8:
-                for i in range(2**bmp_header.bits_per_pixel):
-                    color = Color.from_bytes(remainder[:4])
-                    # convert RGB0 to RGBA
-                    color.alpha = 255
-                    color_map.append(color)
-                    remainder = remainder[4:]
-            image_data = []
-            rows = []
-
-            bitstream = Bitstream(remainder)
-            for i in range(bmp_header.height>>1):
-                row = []
-                for j in range(bmp_header.width):
-                    row.append(bitstream.pop_bits(bmp_header.bits_per_pixel))
-                excess_bits = (32 - ((bmp_header.width * bmp_header.bits_per_pixel) % 32)) & 31
-                # rows always round to nearest 4 bytes
-                if excess_bits:
-                    bitstream.pop_bits(excess_bits)
-                rows.append(row)
-            remainder = bitstream.remaining_buffer()
-            rows.reverse()
-            for row in rows:
-                image_data.extend(row)
-            if bmp_header.bits_per_pixel == 32:
-                map_data = [0] * len(image_data)
+    def entries(cls, data) -> typing.List[IcoEntry]:
+        '''
+        The sizes and bit depths of the images, from their bitmap headers rather than from the directory, where 256
+        pixels are stored as 0 and cursors store their hotspot instead of the bit depth.
+        '''
+        entries = []
+        for index, image_info in enumerate(cls.directory(data)):
+            bitmap = data[image_info.data_offset:image_info.data_offset+40]
+            if bytes(bitmap[:8]) == PNG_SIGNATURE:
+                # the IHDR chunk follows the signature
+                width, height, bit_depth, color_type = struct.unpack_from(">IIBB", data, image_info.data_offset + 16)
+                channels = PNG_CHANNELS.get(color_type, 1)
+                entries.append(IcoEntry(index, width, height, bit_depth * channels, True))
             else:
-                map_data = []
-                rows = []
-                bitstream = Bitstream(remainder)
-                for i in range(bmp_header.height>>1):
-                    row = []
-                    for j in range(bmp_header.width):
-                        row.append(bitstream.pop_bits(1))
-                    # rows always round to nearest 4 bytes
-                    excess_bits = (32 - ((bmp_header.width * 1) % 32)) & 31
-                    if excess_bits:
-                        bitstream.pop_bits(excess_bits)
-                    rows.append(row)
-                rows.reverse()
-                for row in rows:
-                    map_data.extend(row)
-
-            image = IcoImage(image_info, bmp_header,
-                             color_map, image_data, map_data)
-            images.append(image)
-            images_data = images_data[len(bytes(image_info[-1])):]
-
-            #TODO: support more than 1 image per ico (currently seems to not always work...
-            break
-
-
-        return cls(reserved, image_type, image_count, images)
+                bmp_header = BitmapInfoHeader.from_bytes(bitmap)
+                entries.append(IcoEntry(index, bmp_header.width, bmp_header.height >> 1, bmp_header.bits_per_pixel,
+                                        False))
+        return entries
+
+    @staticmethod
+    def best_entry(entries: typing.List[IcoEntry], size=None, bits_per_pixel=None) -> IcoEntry:
+        '''
+        The entry closest to size (on its larger side), then to bits_per_pixel, the deepest one if it is not given,
+        then the first one. Png entries are only picked when there is nothing else.
+        '''
+        def distance(entry):
+            return (entry.png,
+                    abs(max(entry.width, entry.height) - size) if size is not None else 0,
+                    abs(entry.bits_per_pixel - bits_per_pixel) if bits_per_pixel is not None else -entry.bits_per_pixel,
+                    entry.index)
+        return min(entries, key=distance)
+
+    @classmethod
+    @stats.timed("ico_decode")
+    def from_bytes(cls, data, verbose=False, size=None, bits_per_pixel=None):
+        '''
+        Reads the whole directory, but only decodes one image, which is the only one in images: the first that is not
+        png compressed, or the best match for size and bits_per_pixel if either is given (see best_entry).
+        '''
+        reserved, image_type, image_count = struct.unpack_from("<HHH", data)
+        directory = cls.directory(data)
+        if size is None and bits_per_pixel is None:
+            index = next((index for index, image_info in enumerate(directory)
+                          if bytes(data[image_info.data_offset:image_info.data_offset+8]) != PNG_SIGNATURE), 0)
+        else:
+            index = cls.best_entry(cls.entries(data), size, bits_per_pixel).index
+        image_info = directory[index]
+        if bytes(data[image_info.data_offset:image_info.data_offset+8]) == PNG_SIGNATURE:
+            raise NotImplementedError("png compressed icons are not supported")
+        bmp_header = BitmapInfoHeader.from_bytes(data[image_info.data_offset:image_info.data_offset+40])
+        # now repeat with the deciphered size
+        bmp_header = BitmapInfoHeader.from_bytes(data[image_info.data_offset:image_info.data_offset+bmp_header.header_size])
+        remainder = data[image_info.data_offset+bmp_header.header_size:image_info.data_offset+image_info.data_size]
+        color_map = []
+        if bmp_header.bits_per_pixel <= 8:
+            for i in range(2**bmp_header.bits_per_pixel):
+                color = Color.from_bytes(remainder[:4])
+                # convert RGB0 to RGBA
+                color.alpha = 255
+                color_map.append(color)
+                remainder = remainder[4:]
+        pixel_rows = bmp_header.height >> 1
+        image_data, remainder = decode_rows(remainder, bmp_header.width, pixel_rows, bmp_header.bits_per_pixel)
+        stats.count("pixels_decoded", len(image_data))
+        if bmp_header.bits_per_pixel == 32:
+            # the colors stand in for the pixel values, which only differ from them by their alpha, so that the image
+            # holds 4 bytes per pixel rather than the values, the colors and an empty mask
+            colors = packed_colors(image_data, None, color_map, 32)
+            image = IcoImage(image_info, bmp_header, color_map, colors, None, colors)
+        else:
+            map_data, remainder = decode_rows(remainder, bmp_header.width, pixel_rows, 1)
+            image = IcoImage.from_pixels(image_info, bmp_header, color_map, image_data, map_data)
+        return cls(reserved, image_type, image_count, [image])
+
+
+if __name__ == "__main__":
+    noise = [0x7c]
+    for _ in range(4000):
+        noise.append((noise[-1] * 1103515245 + 12345) & 0x7fffffff)
+    noise = bytes(n >> 16 & 0xff for n in noise)
+
+    # the numpy decoding matches the bitstream one, at odd widths whose rows are padded, with data following
+    for test_bits in (1, 2, 4, 8, 24, 32):
+        for test_width in (1, 3, 5, 7, 13, 16):
+            test_height = 3
+            test_data = noise[:((test_width * test_bits + 31) // 32) * 4 * test_height + 5]
+            test_pixels, test_remainder = _decode_rows_python(test_data, test_width, test_height, test_bits)
+            assert len(test_pixels) == test_width * test_height
+            if numpy is not None:
+                numpy_pixels, numpy_remainder = _decode_rows_numpy(test_data, test_width, test_height, test_bits)
+                assert numpy_pixels == test_pixels and bytes(numpy_remainder) == bytes(test_remainder)
+
+    # remapping the indices of an indexed icon gives the pixels palettizing its colors would, with or without numpy
+    test_palette = [Color(noise[i], noise[i + 1], noise[i + 2], 255) for i in range(0, 60, 3)]
+    for test_bits in (1, 4, 8):
+        test_color_map = [Color(noise[i], noise[i + 1], noise[i + 2], 255)
+                          for i in range(100, 100 + 3 * 2**test_bits, 3)]
+        test_image_data = array.array('B', (value % 2**test_bits for value in noise[1000:1400]))
+        for test_mask in (bytes(400), array.array('B', (value & 1 for value in noise[2000:2400]))):
+            test_colors = packed_colors(test_image_data, test_mask, test_color_map, test_bits)
+            expected = bytes(palettize(test_colors, None, PaletteMapper(test_palette), len(test_palette)))
+            assert remap_indices(test_image_data, test_mask, test_color_map, PaletteMapper(test_palette),
+                                 len(test_palette)) == expected
+            if numpy is not None:
+                numpy, numpy_module = None, numpy
+                assert remap_indices(test_image_data, test_mask, test_color_map, PaletteMapper(test_palette),
+                                     len(test_palette)) == expected
+                numpy = numpy_module
 
+    # the numpy packed colors match the python ones, masks applied and alphas normalized
+    test_words = array.array('I', (int.from_bytes(noise[i:i + 4], 'big') for i in range(0, 1600, 4)))
+    for test_bits in (1, 4, 8, 24, 32):
+        if test_bits <= 8:
+            test_image_data = array.array('B', (value % 2**test_bits for value in noise[1000:1400]))
+        else:
+            test_image_data = array.array('I', (word % 2**test_bits for word in test_words))
+        test_color_map = [Color(noise[i], noise[i + 1], noise[i + 2], 255) for i in range(100, 100 + 3 * 256, 3)]
+        for test_mask in (None, bytes(400), array.array('B', (value & 1 for value in noise[2000:2400]))):
+            if test_mask is None and test_bits <= 8:
+                continue
+            test_colors = _packed_colors_python(test_image_data, test_mask, test_color_map, test_bits)
+            assert len(test_colors) == 400
+            if numpy is not None:
+                assert _packed_colors_numpy(test_image_data, test_mask, test_color_map, test_bits) == test_colors
 
+    # the numpy box filter matches the python one, with partial boxes, half transparent ones and a factor of 1
+    for test_width, test_height in ((1, 1), (7, 5), (16, 16), (13, 10)):
+        test_colors = array.array('I', (0 if word & 3 == 0 else word | 0xFF
+                                        for word in test_words[:test_width * test_height]))
+        for test_factor in (1, 2, 3, 4):
+            test_scaled = _downscale_python(test_colors, test_width, test_height, test_factor)
+            assert len(test_scaled) == -(-test_width // test_factor) * -(-test_height // test_factor)
+            if numpy is not None:
+                assert _downscale_numpy(test_colors, test_width, test_height, test_factor) == test_scaled
+    assert _downscale_python(test_colors, 13, 10, 1) == test_colors
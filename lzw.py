@@ -1,73 +1,280 @@
-from typing import List
 import struct
 
 from bitstream import Bitstream
+import stats
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 
-def encode_uncompressed(pixels, palette_size=256):
-    assert palette_size <= 128
-    output = b''
-    palette_size_bits = 1
-    while 1 << palette_size_bits < palette_size:
-        palette_size_bits += 1
-    lzw_header = struct.pack("B", max(2, palette_size_bits))
-    output += lzw_header
-
-    remaining_pixels = pixels
-    while len(remaining_pixels):
-        chunk = remaining_pixels[:126]
-        remaining_pixels = remaining_pixels[126:]
-
-        output += struct.pack("BB", len(chunk) + 1, 0x80)
-        row = []
-        for j in chunk:
-            row.append(j)
-        output += bytes(row)
-
-        # reset the color table, to ensure we do not grow more the table any more
-        output += struct.pack("BB", 0x1, 0x81)
-    output += b'\0'
-    return output
+# GIF codes are at most 12 bits wide
+MAX_CODES = 0x1000
 
+FAST = "fast"
+GREEDY = "greedy"
+AUTO = "auto"
+MODES = (FAST, GREEDY, AUTO)
+# the pixels AUTO judges a frame on
+AUTO_SAMPLE = 4096
 
-def encode(pixels, max_compression_bits=None, palette_size=256, extra_entries=(("CLEAR",), ("END",))):
-    output_buffer = b''
+
+def _min_code_size(palette_size):
     palette_size_bits = 1
     while 1 << palette_size_bits < palette_size:
         palette_size_bits += 1
-    if max_compression_bits == 1:
-        return encode_uncompressed(pixels, palette_size=palette_size)
+    return max(2, palette_size_bits)
+
+
+def _literal_run(min_code_size):
+    # after a clear, the decoder adds an entry per code but the first, and widens its codes once the dictionary
+    # reaches 1 << (min_code_size + 1) entries: clearing every this many literals keeps them at their narrowest
+    return (1 << min_code_size) - 2
+
+
+def _literal_codes_python(pixels, min_code_size):
+    clear_code = 1 << min_code_size
+    run = _literal_run(min_code_size)
+    codes = []
+    for start in range(0, len(pixels), run):
+        codes.append(clear_code)
+        codes.extend(pixels[start:start+run])
+    if not codes:
+        codes.append(clear_code)
+    codes.append(clear_code + 1)
     output_bitstream = Bitstream(b'')
-    lzw_header = struct.pack("B", max(2, palette_size_bits))
-    output_buffer += lzw_header
-    dictionary : List[tuple] = [(i,) for i in range(palette_size)]
-    for i in extra_entries:
-        dictionary.append(i)
-    index = 0
-
-    current_bits = palette_size_bits + 1
-    output_bitstream.push_bits(dictionary.index(("CLEAR",)), current_bits)
-    while index < len(pixels):
-        if (1 << current_bits) < len(dictionary):
+    output_bitstream.push_many(codes, min_code_size + 1)
+    return output_bitstream.buffer, len(codes)
+
+
+def _literal_codes_numpy(pixels, min_code_size):
+    clear_code = 1 << min_code_size
+    run = _literal_run(min_code_size)
+    width = min_code_size + 1
+    if isinstance(pixels, (bytes, bytearray)):
+        pixels = numpy.frombuffer(pixels, dtype=numpy.uint8)
+    pixels = numpy.asarray(pixels, dtype=numpy.uint16)
+    run_count = max(1, -(-len(pixels) // run))
+    # one row per run of literals, led by a clear code, the padding of the last one cut off below
+    codes = numpy.empty((run_count, run + 1), dtype=numpy.uint16)
+    codes[:, 0] = clear_code
+    codes[:, 1:] = numpy.resize(pixels, run_count * run).reshape(run_count, run)
+    codes = numpy.append(codes.reshape(-1)[:len(pixels) + run_count], numpy.uint16(clear_code + 1))
+    # the width lowest bits of each code, least significant first
+    bits = numpy.unpackbits(codes.astype('<u2').view(numpy.uint8).reshape(-1, 2), axis=1, bitorder='little')
+    return numpy.packbits(bits[:, :width].reshape(-1), bitorder='little').tobytes(), len(codes)
+
+
+def _greedy_codes(pixels, min_code_size):
+    ''':return: the codes, their widths and the number of times the dictionary was cleared once full'''
+    clear_code = 1 << min_code_size
+    end_code = clear_code + 1
+
+    # maps (prefix code << 8 | pixel) to the code of the extended string, so that growing the current match by
+    # one pixel is a single lookup instead of a scan over the whole dictionary.
+    dictionary = {}
+    next_code = end_code + 1
+    current_bits = min_code_size + 1
+    codes = [clear_code]
+    resets = 0
+    widths = [current_bits]
+
+    pixel_iter = iter(pixels)
+    prefix = next(pixel_iter, None)
+    if prefix is not None:
+        for pixel in pixel_iter:
+            key = prefix << 8 | pixel
+            code = dictionary.get(key)
+            if code is not None:
+                prefix = code
+                continue
+            codes.append(prefix)
+            widths.append(current_bits)
+            # the decoder adds its entries one code behind us, so widen once the code it is about to add needs it
+            if next_code >= (1 << current_bits) and current_bits < 12:
+                current_bits += 1
+            if next_code < MAX_CODES:
+                dictionary[key] = next_code
+                next_code += 1
+            else:
+                # the table is full: start over rather than freezing it
+                codes.append(clear_code)
+                resets += 1
+                widths.append(current_bits)
+                dictionary.clear()
+                next_code = end_code + 1
+                current_bits = min_code_size + 1
+            prefix = pixel
+        codes.append(prefix)
+        widths.append(current_bits)
+        if next_code >= (1 << current_bits) and current_bits < 12:
             current_bits += 1
 
-        entry = (pixels[index],)
-        for i in range(1,len(dictionary)+1):
-            if tuple(pixels[index:index+len(dictionary[0-i])]) == dictionary[0-i]:
-                if len(dictionary[0-i]) > len(entry):
-                    entry = dictionary[0-i]
+    codes.append(end_code)
+    widths.append(current_bits)
+    return codes, widths, resets
+
+
+def _sub_blocks(min_code_size, data) -> bytes:
+    blocks = [struct.pack("B", min_code_size)]
+    for i in range(0, len(data), 255):
+        chunk = data[i:i+255]
+        blocks.append(struct.pack("B", len(chunk)))
+        blocks.append(chunk)
+    blocks.append(b'\0') # chunk len 0 == end
+    return b''.join(blocks)
+
+
+def uncompressed_size(pixel_count, palette_size=256):
+    '''the length of encode_uncompressed's output for that many pixels'''
+    min_code_size = _min_code_size(palette_size)
+    code_count = pixel_count + max(1, -(-pixel_count // _literal_run(min_code_size))) + 1
+    data_size = -(-code_count * (min_code_size + 1) // 8)
+    return 1 + data_size + -(-data_size // 255) + 1
+
+
+def _encode_uncompressed(pixels, palette_size):
+    '''the output, the code count and the dictionary reset count (none) of encode_uncompressed'''
+    min_code_size = _min_code_size(palette_size)
+    if numpy is not None:
+        data, code_count = _literal_codes_numpy(pixels, min_code_size)
+    else:
+        data, code_count = _literal_codes_python(pixels, min_code_size)
+    return _sub_blocks(min_code_size, data), code_count, 0
+
+
+def encode_uncompressed(pixels, palette_size=256):
+    '''
+    Encodes the pixels as literal codes only, clearing the dictionary before the codes would widen: a fixed
+    min code size + 1 bits per pixel whatever the pixels are, for next to no work. Uses numpy when it is installed.
+    '''
+    return _encode_uncompressed(pixels, palette_size)[0]
+
+
+def _encode_greedy(pixels, palette_size):
+    '''the output, the code count and the dictionary reset count of encode_greedy'''
+    min_code_size = _min_code_size(palette_size)
+    codes, widths, resets = _greedy_codes(pixels, min_code_size)
+    output_bitstream = Bitstream(b'')
+    output_bitstream.push_many(codes, widths)
+    return _sub_blocks(min_code_size, output_bitstream.buffer), len(codes), resets
+
+
+def encode_greedy(pixels, palette_size=256):
+    '''Encodes the pixels as the longest strings of the dictionary, growing it by one string per code.'''
+    return _encode_greedy(pixels, palette_size)[0]
+
+
+def _auto_mode(pixels, palette_size):
+    '''
+    GREEDY when it should compress a frame better than FAST, judged on a sample of it from the middle. The codes of
+    the sample are then a good predictor of the size, being as noisy or repetitive as the frame.
+    '''
+    middle = max(0, (len(pixels) - AUTO_SAMPLE) // 2)
+    sample = pixels[middle:middle + AUTO_SAMPLE]
+    _, widths, _ = _greedy_codes(sample, _min_code_size(palette_size))
+    return GREEDY if sum(widths) // 8 < uncompressed_size(len(sample), palette_size) else FAST
+
+
+@stats.timed("lzw")
+def encode(pixels, max_compression_bits=None, palette_size=256, mode=GREEDY):
+    '''
+    :param pixels: palette indices, a sequence of ints or bytes
+    :param max_compression_bits: 1 is the same as the FAST mode, kept for compatibility
+    :param mode: FAST (encode_uncompressed) for speed, GREEDY (encode_greedy) for size, or AUTO to pick one per
+        frame, whichever should make it smaller
+    '''
+    if max_compression_bits == 1:
+        mode = FAST
+    if mode not in MODES:
+        raise ValueError(f"unknown lzw mode {mode!r}, expected one of {MODES}")
+    if mode == AUTO and len(pixels) <= AUTO_SAMPLE:
+        # the frame is its own sample, keep its greedy encoding unless literals are smaller
+        output, code_count, resets = _encode_greedy(pixels, palette_size)
+        if len(output) > uncompressed_size(len(pixels), palette_size):
+            output, code_count, resets = _encode_uncompressed(pixels, palette_size)
+    else:
+        if mode == AUTO:
+            mode = _auto_mode(pixels, palette_size)
+        if mode == FAST:
+            output, code_count, resets = _encode_uncompressed(pixels, palette_size)
+        else:
+            output, code_count, resets = _encode_greedy(pixels, palette_size)
+    if stats.current() is not None:
+        # the codes of the returned encoding only, not those AUTO discarded
+        stats.count("lzw_codes", code_count)
+        stats.count("lzw_dictionary_resets", resets)
+        stats.count("lzw_input_pixels", len(pixels))
+        stats.count("lzw_output_bytes", len(output))
+    return output
+
+
+def decode(data):
+    """
+    Decodes the output of encode (the LZW minimum code size byte followed by the data sub-blocks) back into a list of
+    palette indices.
+    """
+    min_code_size = data[0]
+    clear_code = 1 << min_code_size
+    end_code = clear_code + 1
+    blocks = []
+    index = 1
+    while data[index]:
+        blocks.append(data[index+1:index+1+data[index]])
+        index += 1 + data[index]
+    # Bitstream reads from the most significant bit, but GIF packs codes from the least significant one
+    bitstream = Bitstream(bytes(int(f"{byte:08b}"[::-1], 2) for byte in b''.join(blocks)))
 
-        output_bitstream.push_bits(dictionary.index(entry), current_bits)
+    pixels = []
+    dictionary = []
+    previous = None
+    current_bits = min_code_size + 1
+    while True:
+        code = int(f"{bitstream.pop_bits(current_bits):0{current_bits}b}"[::-1], 2)
+        if code == clear_code:
+            dictionary = [(i,) for i in range(clear_code)] + [(), ()]
+            previous = None
+            current_bits = min_code_size + 1
+            continue
+        if code == end_code:
+            return pixels
+        if previous is None:
+            entry = dictionary[code]
+        else:
+            entry = dictionary[code] if code < len(dictionary) else previous + previous[:1]
+            if len(dictionary) < MAX_CODES:
+                dictionary.append(previous + entry[:1])
+                if len(dictionary) == (1 << current_bits) and current_bits < 12:
+                    current_bits += 1
+        pixels.extend(entry)
+        previous = entry
 
-        index += len(entry)
 
-        if index < len(pixels) and len(dictionary) < 0x1000:
-            dictionary.append(entry + (pixels[index],))
+if __name__ == "__main__":
+    # outputs of the original linear-scan encoder, which the dictionary based one has to reproduce byte for byte
+    assert encode([0, 1, 2, 3] * 4, palette_size=4).hex() == '02064434869a370500'
+    assert encode([i % 7 for i in range(120)], palette_size=8).hex() == \
+        '031a082143658a39b8da8b96ca5b27f61db769d9279621098ea67a2500'
+    assert encode([(i * i + i // 3) % 13 for i in range(200)], palette_size=16).hex() == \
+        '04551004a208602c18760a29498014c360280393200a5000c9c18a03205116a6711e289226948ae582c91434dba472c96c3a9fd0a87' \
+        '44aad5aafd80c51bb3175cf9e14581d628ddbee32e7e4457f54e1b5a8457295b80800'
+    assert encode([5] * 100, palette_size=256).hex() == '0812000b081c48b0a0c18308132a5cc8b061c28000'
 
-    output_bitstream.push_bits(dictionary.index(("END",)), current_bits)
-    for i in range(0, len(output_bitstream.buffer), 255):
-        chunk = output_bitstream.buffer[i:i+255]
-        output_buffer += struct.pack("B%ds" % len(chunk), len(chunk), chunk)
-    output_buffer += b'\0' # chunk len 0 == end
-    return output_buffer
+    # noise fills the 4096 entry dictionary several times over, exercising the CLEAR resets
+    noise = [0x7c]
+    for _ in range(30000):
+        noise.append((noise[-1] * 1103515245 + 12345) & 0x7fffffff)
+    for test_pixels, test_palette_size in (([], 4), ([1], 2), ([0, 1, 0, 1, 1, 0, 0, 1] * 5, 2),
+                                           ([(i // 3 * 31) % 16 for i in range(3000)], 16),
+                                           ([n >> 16 & 0xff for n in noise], 256),
+                                           ([n >> 16 & 0xf for n in noise], 16)):
+        assert decode(encode(test_pixels, palette_size=test_palette_size)) == test_pixels
+        for test_mode in MODES:
+            assert decode(encode(test_pixels, palette_size=test_palette_size, mode=test_mode)) == test_pixels
+        uncompressed = encode(bytes(test_pixels), palette_size=test_palette_size, mode=FAST)
+        assert len(uncompressed) == uncompressed_size(len(test_pixels), test_palette_size)
+        if numpy is not None:
+            numpy, numpy_module = None, numpy
+            assert encode(test_pixels, palette_size=test_palette_size, mode=FAST) == uncompressed
+            numpy = numpy_module
@@ -0,0 +1,186 @@
+import itertools
+import operator
+import typing
+
+from ani import AniFrame
+
+
+# gif disposal methods, what happens to a frame's rectangle before the next frame is drawn
+DO_NOT_DISPOSE = 1
+RESTORE_BACKGROUND = 2
+
+
+# the longest delay of a gif frame is 65535 hundredths of a second, in jiffies (1/60s)
+MAX_DELAY = 65535 * 60 // 100
+
+
+class Rect(typing.NamedTuple):
+    left: int
+    top: int
+    width: int
+    height: int
+
+
+def _bounding_box(width, pixels, other_pixels, differs) -> typing.Optional[Rect]:
+    '''the bounding box of the pixels for which differs(pixel, other_pixel) holds, None if there are none'''
+    left = width
+    right = top = bottom = -1
+    for y in range(len(pixels) // width):
+        row = pixels[y*width:(y+1)*width]
+        other_row = other_pixels[y*width:(y+1)*width]
+        if row == other_row:
+            continue
+        columns = [x for x, (pixel, other_pixel) in enumerate(zip(row, other_row)) if differs(pixel, other_pixel)]
+        if columns:
+            left = min(left, columns[0])
+            right = max(right, columns[-1])
+            if top < 0:
+                top = y
+            bottom = y
+    if top < 0:
+        return None
+    return Rect(left, top, right - left + 1, bottom - top + 1)
+
+
+def _union(rect: typing.Optional[Rect], other: typing.Optional[Rect]) -> typing.Optional[Rect]:
+    if rect is None or other is None:
+        return rect or other
+    left = min(rect.left, other.left)
+    top = min(rect.top, other.top)
+    right = max(rect.left + rect.width, other.left + other.width)
+    bottom = max(rect.top + rect.height, other.top + other.height)
+    return Rect(left, top, right - left, bottom - top)
+
+
+def delta_frames(targets: typing.Iterable[typing.Sequence[int]], width, height, transparency_index) \
+        -> typing.Iterator[typing.Tuple[int, Rect, typing.List[int]]]:
+    '''
+    Turns full canvas palettized frames into the smallest frames drawing the same animation: each frame only covers
+    the bounding box of the pixels that differ from what the previous frames left on the canvas, the pixels inside
+    it that are already right being made transparent so that they compress to long runs.
+
+    Frames are left in place (DO_NOT_DISPOSE) unless the next frame needs some of their pixels to become transparent
+    again, in which case their rectangle is grown to cover those pixels and cleared (RESTORE_BACKGROUND). The last
+    frame clears everything, so that every loop starts from an empty canvas.
+
+    :return: (disposal method, rectangle, pixels of the rectangle) per target
+    '''
+    empty = [transparency_index] * (width * height)
+
+    def needs_clearing(next_pixel, pixel):
+        return next_pixel == transparency_index and pixel != transparency_index
+
+    canvas = empty
+    previous = None
+    # the trailing empty target makes the last frame clear the canvas
+    for target in itertools.chain(targets, [empty]):
+        target = list(target)
+        if previous is not None:
+            previous_target, previous_canvas, rect = previous
+            clear_rect = _bounding_box(width, target, previous_target, needs_clearing)
+            if clear_rect is None:
+                disposal = DO_NOT_DISPOSE
+                canvas = previous_target
+            else:
+                disposal = RESTORE_BACKGROUND
+                rect = _union(rect, clear_rect)
+                canvas = list(previous_target)
+                for y in range(rect.top, rect.top + rect.height):
+                    canvas[y*width + rect.left:y*width + rect.left + rect.width] = empty[:rect.width]
+            if rect is None:
+                # nothing changes: a single transparent pixel
+                rect = Rect(0, 0, 1, 1)
+            pixels = []
+            for y in range(rect.top, rect.top + rect.height):
+                row = slice(y*width + rect.left, y*width + rect.left + rect.width)
+                pixels.extend(pixel if pixel != canvas_pixel else transparency_index
+                              for pixel, canvas_pixel in zip(previous_target[row], previous_canvas[row]))
+            yield disposal, rect, pixels
+        previous = target, canvas, _bounding_box(width, target, canvas, operator.ne)
+
+
+def _same_image(frame: AniFrame, other: AniFrame):
+    if frame.source_index is not None and frame.source_index == other.source_index:
+        return True
+    return frame.ico.images[0].colors == other.ico.images[0].colors
+
+
+def collapse_frames(frames: typing.Iterable[AniFrame]) -> typing.Iterator[AniFrame]:
+    '''
+    Merges the runs of consecutive frames showing the same icon, or pixel identical ones, into a single frame lasting
+    as long as the whole run, split again only where a gif frame could not hold the total delay (MAX_DELAY).
+    '''
+    run = None
+    for frame in frames:
+        if run is not None and _same_image(run, frame) and run.post_delay + frame.post_delay <= MAX_DELAY:
+            run.post_delay += frame.post_delay
+            continue
+        if run is not None:
+            yield run
+        run = AniFrame(frame.ico, frame.post_delay, frame.source_index)
+    if run is not None:
+        yield run
+
+
+if __name__ == "__main__":
+    noise = [0x7c]
+    for _ in range(2000):
+        noise.append((noise[-1] * 1103515245 + 12345) & 0x7fffffff)
+    noise = [n >> 16 for n in noise]
+
+    # delta frames drawn one over the other show the same frames as the full ones, and leave the canvas empty
+    test_width, test_height, test_transparent = 7, 5, 3
+    test_size = test_width * test_height
+    test_targets = [[n % 4 for n in noise[i*test_size:(i+1)*test_size]] for i in range(6)]
+    # a moving block, a repeated frame, an empty one and one partly uncovering the canvas
+    test_targets += [[1 if 2 <= x - i < 4 and 1 <= y < 3 else test_transparent
+                      for y in range(test_height) for x in range(test_width)] for i in range(4)]
+    test_targets += [test_targets[-1], [test_transparent] * test_size, test_targets[0], test_targets[0][:20] +
+                     [test_transparent] * (test_size - 20)]
+    test_canvas = [test_transparent] * test_size
+    test_deltas = list(delta_frames(test_targets, test_width, test_height, test_transparent))
+    assert len(test_deltas) == len(test_targets)
+    for test_target, (test_disposal, test_rect, test_pixels) in zip(test_targets, test_deltas):
+        assert len(test_pixels) == test_rect.width * test_rect.height
+        for y in range(test_rect.height):
+            for x in range(test_rect.width):
+                pixel = test_pixels[y*test_rect.width + x]
+                if pixel != test_transparent:
+                    test_canvas[(test_rect.top + y)*test_width + test_rect.left + x] = pixel
+        assert test_canvas == test_target
+        if test_disposal == RESTORE_BACKGROUND:
+            for y in range(test_rect.top, test_rect.top + test_rect.height):
+                test_canvas[y*test_width + test_rect.left:y*test_width + test_rect.left + test_rect.width] = \
+                    [test_transparent] * test_rect.width
+    assert test_canvas == [test_transparent] * test_size
+
+    # collapsed frames last as long as the frames they merge, in the same order, each within MAX_DELAY
+    import array
+    from ico import Ico, IcoImage
+    test_icons = [Ico(0, 1, 1, [IcoImage.from_colors(array.array('I', [color] * 4), 2, 2)])
+                  for color in (0, 0x112233FF, 0x112233FF, 0x445566FF)]
+    test_frames = []
+    for i in range(200):
+        # the two middle icons are pixel identical, the long delays force splits
+        index = noise[i] % 7 % len(test_icons)
+        test_frames.append(AniFrame(test_icons[index], noise[i + 200] % (MAX_DELAY // 3) + 1, index))
+    test_collapsed = list(collapse_frames(test_frames))
+    assert sum(frame.post_delay for frame in test_collapsed) == sum(frame.post_delay for frame in test_frames)
+    assert all(0 < frame.post_delay <= MAX_DELAY for frame in test_collapsed)
+    assert len(test_collapsed) < len(test_frames)
+
+    def runs(frames):
+        # the colors shown and for how long, consecutive frames showing the same colors merged
+        shown = []
+        for frame in frames:
+            colors = frame.ico.images[0].colors
+            if shown and shown[-1][0] == colors:
+                shown[-1][1] += frame.post_delay
+            else:
+                shown.append([colors, frame.post_delay])
+        return shown
+
+    assert runs(test_collapsed) == runs(test_frames)
+    for frame, next_frame in zip(test_collapsed, test_collapsed[1:]):
+        # only split where the merged frame would be too long
+        assert not _same_image(frame, next_frame) or frame.post_delay + next_frame.post_delay > MAX_DELAY
@@ -0,0 +1,204 @@
+import bisect
+import collections
+import heapq
+import itertools
+import operator
+import typing
+
+from bmp import Color
+import stats
+
+
+# the nearest color searches narrow the palette down through cells of the RGB cube of these sides (as shifts), each
+# cell's candidates being picked among those of the enclosing larger cell
+CELL_BITS = (7, 6, 5, 4)
+# candidate lists this short are not worth narrowing down further
+MIN_CANDIDATES = 8
+
+
+def pack_color(color: Color) -> int:
+    '''packs a color as blue << 24 | green << 16 | red << 8 | alpha, the layout of a decoded 32bpp pixel'''
+    return color.blue << 24 | color.green << 16 | color.red << 8 | color.alpha
+
+
+def unpack_color(color: int) -> Color:
+    return Color(color >> 24, color >> 16 & 0xFF, color >> 8 & 0xFF, color & 0xFF)
+
+
+class PaletteMapper:
+    '''
+    Maps packed colors (see pack_color) to palette indices: the first entry equal to the color if there is one,
+    otherwise the entry closest to it, as the largest difference of the red, green and blue components, preferring
+    the lowest index on ties.
+
+    Build it once per palette and share it between all the frames using that palette: every answer is cached, and
+    misses only compare the color with the few entries that can be the closest to some color of a small cell of the
+    RGB cube around it, rather than with the whole palette.
+    '''
+    def __init__(self, palette: typing.List[Color]):
+        self.palette = palette
+        self.cache: typing.Dict[int, int] = {}
+        for index, color in enumerate(palette):
+            self.cache.setdefault(pack_color(color), index)
+        self._entries = [(index, color.red, color.green, color.blue) for index, color in enumerate(palette)]
+        # candidate entries by (cell side shift, cell coordinates), filled in as cells get hit
+        self._cells: typing.Dict[typing.Tuple[int, int, int, int], list] = {}
+
+    def lookup(self, color: int) -> int:
+        index = self.cache.get(color)
+        if index is None:
+            index = self.cache[color] = self.nearest(color >> 8 & 0xFF, color >> 16 & 0xFF, color >> 24)
+        return index
+
+    @staticmethod
+    def _cell_candidates(entries, red_low, green_low, blue_low, size):
+        red_high, green_high, blue_high = red_low + size - 1, green_low + size - 1, blue_low + size - 1
+        # every color of the cell is at most this far from some entry...
+        reach = min(max(red - red_low, red_high - red, green - green_low, green_high - green, blue - blue_low,
+                        blue_high - blue)
+                    for _, red, green, blue in entries)
+        # ...so entries further than that from all of the cell can never be the closest
+        return [entry for entry in entries
+                if max(red_low - entry[1], entry[1] - red_high, green_low - entry[2], entry[2] - green_high,
+                       blue_low - entry[3], entry[3] - blue_high) <= reach]
+
+    def nearest(self, red, green, blue):
+        candidates = self._entries
+        for shift in CELL_BITS:
+            if len(candidates) <= MIN_CANDIDATES:
+                break
+            cell = (shift, red >> shift, green >> shift, blue >> shift)
+            cell_candidates = self._cells.get(cell)
+            if cell_candidates is None:
+                cell_candidates = self._cells[cell] = self._cell_candidates(
+                    candidates, red >> shift << shift, green >> shift << shift, blue >> shift << shift, 1 << shift)
+            candidates = cell_candidates
+        best = 0
+        margin = 1000
+        for index, palette_red, palette_green, palette_blue in candidates:
+            new_margin = max(abs(red - palette_red), abs(green - palette_green), abs(blue - palette_blue))
+            if new_margin < margin:
+                margin = new_margin
+                best = index
+        return best
+
+
+@stats.timed("palettize")
+def palettize(colors: typing.Iterable[int], mask, mapper: PaletteMapper, transparency_index) -> typing.List[int]:
+    '''
+    Maps packed colors to palette indices, the transparent ones and those with a mask value of 1 to
+    transparency_index.
+
+    :param mask: a sequence of one 0 or 1 per color, or None
+    '''
+    cache = mapper.cache
+    pixels = []
+    hits = misses = 0
+    for index, color in enumerate(colors):
+        if color & 0xFF < 128 or mask and mask[index] == 1:
+            pixels.append(transparency_index)
+        else:
+            palette_index = cache.get(color)
+            if palette_index is None:
+                palette_index = mapper.lookup(color)
+                misses += 1
+            else:
+                hits += 1
+            pixels.append(palette_index)
+    if stats.current() is not None:
+        stats.count("palette_cache_hits", hits)
+        stats.count("palette_cache_misses", misses)
+    return pixels
+
+
+def color_histogram(images, max_samples=None) -> collections.Counter:
+    '''
+    Counts the colors of the visible pixels of all the images in a single pass over them.
+
+    :param images: IcoImages
+    :param max_samples: if given, the pixels are sampled at a regular step so that at most about this many are counted
+    '''
+    images = list(images)
+    histogram = collections.Counter()
+    pixel_count = sum(len(image.colors) for image in images)
+    step = -(-pixel_count // max_samples) if max_samples and pixel_count > max_samples else 1
+    for image in images:
+        histogram.update(image.colors[::step] if step > 1 else image.colors)
+    # the transparent pixels
+    histogram.pop(0, None)
+    return histogram
+
+
+def _box(colors, order):
+    # a heap entry for a box of colors: the widest channel range (negated for the min heap), the order the box was
+    # made in, the channel with that range, and the colors
+    ranges = [max(values) - min(values) for values in itertools.islice(zip(*colors), 3)]
+    channel = ranges.index(max(ranges))
+    return -ranges[channel], order, channel, colors
+
+
+def median_cut(histogram: typing.Mapping[int, int], color_count) -> typing.List[Color]:
+    '''
+    Reduces a histogram of packed colors to at most color_count opaque colors, by repeatedly splitting the box of
+    colors that spans the widest range on one channel at the median of that channel, weighted by pixel count.
+    Histograms that already fit are returned as they are.
+    '''
+    if len(histogram) <= color_count:
+        return [Color(color >> 24, color >> 16 & 0xFF, color >> 8 & 0xFF, 255) for color in histogram]
+    # (red, green, blue, count) per distinct color
+    colors = [(color >> 8 & 0xFF, color >> 16 & 0xFF, color >> 24, count) for color, count in histogram.items()]
+    boxes = [_box(colors, 0)]
+    box_count = 1
+    while len(boxes) < color_count:
+        negative_range, order, channel, box = heapq.heappop(boxes)
+        if negative_range == 0:
+            # every remaining box is a single color
+            heapq.heappush(boxes, (negative_range, order, channel, box))
+            break
+        box.sort(key=operator.itemgetter(channel))
+        # split at the weighted median, leaving at least one color on each side
+        populations = list(itertools.accumulate(entry[3] for entry in box))
+        split = min(max(bisect.bisect_right(populations, populations[-1] / 2), 1), len(box) - 1)
+        for part in (box[:split], box[split:]):
+            heapq.heappush(boxes, _box(part, box_count))
+            box_count += 1
+    palette = []
+    for _, _, _, box in sorted(boxes, key=operator.itemgetter(1)):
+        population = sum(entry[3] for entry in box)
+        red, green, blue = (round(sum(entry[channel] * entry[3] for entry in box) / population) for channel in range(3))
+        palette.append(Color(blue, green, red, 255))
+    return palette
+
+
+@stats.timed("palette")
+def build_palette(images, color_count, max_samples=None) -> typing.List[Color]:
+    '''
+    Builds a palette of at most color_count opaque colors shared by all the images (transparency is left to the
+    caller), from a histogram of all their pixels.
+
+    :param max_samples: trades quality for time, see color_histogram
+    '''
+    return median_cut(color_histogram(images, max_samples=max_samples), color_count)
+
+
+if __name__ == "__main__":
+    def brute_force_nearest(palette, red, green, blue):
+        # the whole palette scanned, the lowest index winning ties
+        return min(range(len(palette)), key=lambda index: (max(abs(red - palette[index].red),
+                                                               abs(green - palette[index].green),
+                                                               abs(blue - palette[index].blue)), index))
+
+    noise = [0x7c]
+    for _ in range(8000):
+        noise.append((noise[-1] * 1103515245 + 12345) & 0x7fffffff)
+    noise = [n >> 16 & 0xff for n in noise]
+    # random palettes, and coarse ones whose many equidistant entries exercise the ties
+    for test_size, test_step in ((1, 1), (2, 1), (9, 1), (40, 1), (255, 1), (64, 64), (255, 32)):
+        test_palette = [Color(blue // test_step * test_step, green // test_step * test_step,
+                              red // test_step * test_step, 255)
+                        for blue, green, red in zip(noise[0:3*test_size:3], noise[1:3*test_size:3],
+                                                    noise[2:3*test_size:3])]
+        test_mapper = PaletteMapper(test_palette)
+        for blue, green, red in zip(noise[1000::3], noise[1001::3], noise[1002::3]):
+            assert test_mapper.lookup(blue << 24 | green << 16 | red << 8 | 0xFF) == \
+                brute_force_nearest(test_palette, red, green, blue)
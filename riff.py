@@ -7,16 +7,27 @@ class Chunk(typing.NamedTuple):
     ckSize: int
     ckData: bytes
     pad: bytes
+    # position of the chunk header within the buffer it was parsed from
+    offset: int = 0
 
     def __bytes__(self):
-        return struct.pack(f"<4sI{self.ckSize}s", self.ckID, self.ckSize, self.ckData) + self.pad
+        return b''.join((struct.pack("<4sI", self.ckID, self.ckSize), self.ckData, self.pad))
 
     @classmethod
-    def from_bytes(cls, data):
-        ckID, ckSize = struct.unpack("<4sI", data[:8])
-        ckData = data[8:8+ckSize]
-        pad = data[8+ckSize:8+ckSize+1] if ckSize % 2 else b''
-        return cls(ckID, ckSize, ckData, pad)
+    def create(cls, ckID, data):
+        '''a chunk holding data, padded to an even size'''
+        return cls(ckID, len(data), data, b'\0' if len(data) % 2 else b'')
+
+    @classmethod
+    def from_bytes(cls, data, offset=0):
+        '''
+        ckData and pad are views into data rather than copies of it, so data must stay alive as long as the chunk.
+        '''
+        data = memoryview(data)
+        ckID, ckSize = struct.unpack_from("<4sI", data, offset)
+        ckData = data[offset+8:offset+8+ckSize]
+        pad = data[offset+8+ckSize:offset+8+ckSize+1] if ckSize % 2 else b''
+        return cls(ckID, ckSize, ckData, pad, offset)
 
 
 class Riff(typing.NamedTuple):
@@ -25,26 +36,38 @@ class Riff(typing.NamedTuple):
     identifier: bytes
     subChunks: typing.List[Chunk]
     pad: bytes
+    # position of the chunk header within the buffer it was parsed from
+    offset: int = 0
 
     def __bytes__(self):
-        result = struct.pack(f"<4sI4s", self.ckID, self.ckSize, self.identifier)
-        for item in self.subChunks:
-            result += bytes(item)
-        result += self.pad
-        return result
+        return b''.join([struct.pack(f"<4sI4s", self.ckID, self.ckSize, self.identifier)] +
+                        [bytes(item) for item in self.subChunks] + [self.pad])
 
     @classmethod
-    def from_bytes(cls, data):
-        ckID, ckSize, identifier = struct.unpack("<4sI4s", data[:12])
-        inner_data = data[12:12+ckSize]
-        pad = data[12+ckSize:12+ckSize+1] if ckSize % 2 else b''
-        ckData = []
-        while len(inner_data):
-            item = Chunk.from_bytes(inner_data)
-            if item.ckID in (b"RIFF", b"LIST"):
-                item = Riff.from_bytes(bytes(item))
-            inner_data = inner_data[len(bytes(item)):]
-            ckData.append(item)
-        return cls(ckID, ckSize, identifier, ckData, pad)
+    def create(cls, ckID, identifier, subChunks):
+        '''a RIFF or LIST chunk of the sub chunks, its size counting their headers and padding'''
+        return cls(ckID, 4 + sum(8 + item.ckSize + item.ckSize % 2 for item in subChunks), identifier, subChunks, b'')
 
+    @classmethod
+    def from_bytes(cls, data, offset=0, nested=True):
+        '''
+        Walks the chunk headers in place: sub chunk payloads are views into data (which may be a mmap), nothing is
+        copied.
 
+        :param nested: also walk the LIST sub chunks. When False they are left as plain Chunks, whose payload starts
+            with their identifier, and only the top level headers are read.
+        '''
+        data = memoryview(data)
+        ckID, ckSize, identifier = struct.unpack_from("<4sI4s", data, offset)
+        # the size counts the identifier but not the chunk header
+        end = min(offset + 8 + ckSize, len(data))
+        pad = data[end:end+1] if ckSize % 2 else b''
+        ckData = []
+        position = offset + 12
+        while position + 8 <= end:
+            item = Chunk.from_bytes(data, position)
+            if nested and item.ckID in (b"RIFF", b"LIST"):
+                item = Riff.from_bytes(data, position)
+            position += 8 + item.ckSize + item.ckSize % 2
+            ckData.append(item)
+        return cls(ckID, ckSize, identifier, ckData, pad, offset)
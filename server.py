@@ -0,0 +1,328 @@
+import argparse
+import asyncio
+import concurrent.futures
+import json
+import os
+import socket
+import stat
+import struct
+import sys
+import typing
+from concurrent.futures.process import BrokenProcessPool
+
+from ani import Ani
+from ani2gif import convert
+from cache import DEFAULT_MAX_SIZE, ConversionCache, encoded_images
+import lzw
+
+
+DEFAULT_SOCKET = "/tmp/ani2gif.sock"
+DEFAULT_MAX_REQUEST_SIZE = 16 << 20
+DEFAULT_TIMEOUT = 30
+
+# a request is its header, the options as json then the ani file. The reply is its header then the gif, or the error
+# message when the status is not OK. After a REFUSED request, which may not have been read, the connection is closed.
+REQUEST_HEADER = struct.Struct("<II")
+REPLY_HEADER = struct.Struct("<BI")
+OK = 0
+ERROR = 1
+REFUSED = 2
+
+# the options a request may set, see ani2gif.iter_gif. Ani options are applied when reading the file.
+CONVERSION_OPTIONS = ("palette_samples", "delta", "lzw_mode", "collapse")
+ANI_OPTIONS = ("icon_size", "icon_bits_per_pixel")
+
+
+class ServerError(Exception):
+    '''a conversion the server refused or failed'''
+
+
+class _RequestRefused(ServerError):
+    '''a request refused before it was read in full'''
+
+
+def _convert_request(contents: bytes, options: typing.Dict[str, typing.Any], cache: ConversionCache = None) -> bytes:
+    '''run in the worker processes, which keep their image cache across requests'''
+    ani_options = {name: options.pop(name) for name in ANI_OPTIONS if name in options}
+    return convert(Ani(contents, **ani_options), cache, image_cache=encoded_images, **options)
+
+
+def _warm_up():
+    # the imports are done when the worker starts, running something makes sure it has
+    return os.getpid()
+
+
+def _remove_stale_socket(path):
+    '''removes the socket a previous server left at path, refusing to remove anything else'''
+    try:
+        mode = os.lstat(path).st_mode
+    except FileNotFoundError:
+        return
+    if not stat.S_ISSOCK(mode):
+        raise FileExistsError(f"{path} exists and is not a socket")
+    os.remove(path)
+
+
+class Server:
+    '''
+    Converts the ani files sent over a unix socket (or a localhost tcp port) with a pool of worker processes started
+    once, so that requests do not pay for the interpreter startup and imports. A connection can send any number of
+    requests, one at a time.
+
+    :param jobs: the number of worker processes
+    :param max_request_size: larger requests are refused without being read
+    :param timeout: seconds a conversion may take once its request is read, waiting for a free worker included,
+        before an error is replied.
+        The worker keeps running it though, and it keeps counting against max_pending until it is done.
+    :param max_pending: conversions queued or running at once, beyond which only the headers of the requests are
+        read, leaving their clients waiting
+    :param cache: shared by the workers, see ani2gif.convert
+    '''
+    def __init__(self, jobs=None, max_request_size=DEFAULT_MAX_REQUEST_SIZE, timeout=DEFAULT_TIMEOUT,
+                 max_pending=None, cache: ConversionCache = None):
+        self.jobs = jobs or os.cpu_count()
+        self.max_request_size = max_request_size
+        self.timeout = timeout
+        self.max_pending = max_pending or 2 * self.jobs
+        self.cache = cache
+        self._executor: typing.Optional[concurrent.futures.ProcessPoolExecutor] = None
+        self._pending: typing.Optional[asyncio.Semaphore] = None
+
+    def _conversion_done(self, future: asyncio.Future):
+        self._pending.release()
+        if not future.cancelled():
+            # retrieved, so that the failure of a conversion nobody waits for anymore is not logged
+            future.exception()
+
+    def _submit(self, contents, options) -> asyncio.Future:
+        future = asyncio.get_running_loop().run_in_executor(self._executor, _convert_request, contents, options,
+                                                            self.cache)
+        # the slot is given back when the worker is done, not when the reply is sent
+        future.add_done_callback(self._conversion_done)
+        return future
+
+    def _restart_executor(self, broken: concurrent.futures.ProcessPoolExecutor):
+        '''replaces the broken pool with a new one, unless another request already did'''
+        if self._executor is broken:
+            broken.shutdown(wait=False, cancel_futures=True)
+            self._executor = concurrent.futures.ProcessPoolExecutor(max_workers=self.jobs)
+        return self._executor
+
+    async def _handle_request(self, reader: asyncio.StreamReader):
+        options_size, contents_size = REQUEST_HEADER.unpack(await reader.readexactly(REQUEST_HEADER.size))
+        if options_size + contents_size > self.max_request_size:
+            raise _RequestRefused(f"request of {options_size + contents_size} bytes, over the limit of "
+                                  f"{self.max_request_size}")
+        # the request is only read once it has a slot, so that waiting requests do not pile up in memory
+        await self._pending.acquire()
+        future = None
+        try:
+            encoded_options = await reader.readexactly(options_size)
+            contents = await reader.readexactly(contents_size)
+            # the whole request is read, errors from here on leave the connection usable
+            try:
+                options = json.loads(encoded_options) if options_size else {}
+            except ValueError as e:
+                raise ServerError(f"invalid options: {e}")
+            if not isinstance(options, dict):
+                raise ServerError("invalid options: not a json object")
+            unknown = set(options) - set(CONVERSION_OPTIONS) - set(ANI_OPTIONS)
+            if unknown:
+                raise ServerError(f"unknown options {sorted(unknown)}")
+            executor = self._executor
+            try:
+                future = self._submit(contents, options)
+            except BrokenProcessPool:
+                executor = self._restart_executor(executor)
+                future = self._submit(contents, options)
+            try:
+                return await asyncio.wait_for(asyncio.shield(future), self.timeout)
+            except asyncio.TimeoutError:
+                raise ServerError(f"conversion took over {self.timeout}s")
+            except BrokenProcessPool as e:
+                # a worker died: the pool fails every later conversion until it is replaced
+                self._restart_executor(executor)
+                raise ServerError(f"{type(e).__name__}: {e}")
+            except Exception as e:
+                raise ServerError(f"{type(e).__name__}: {e}")
+        finally:
+            if future is None:
+                self._pending.release()
+
+    async def _handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while not reader.at_eof():
+                try:
+                    gif = await self._handle_request(reader)
+                except ServerError as e:
+                    message = str(e).encode()
+                    refused = isinstance(e, _RequestRefused)
+                    writer.write(REPLY_HEADER.pack(REFUSED if refused else ERROR, len(message)) + message)
+                    await writer.drain()
+                    if refused:
+                        # the rest of the request was not read, the connection can not be reused
+                        break
+                    continue
+                writer.write(REPLY_HEADER.pack(OK, len(gif)))
+                writer.write(gif)
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            # the client went away
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, path=DEFAULT_SOCKET, port=None):
+        '''listens on the unix socket at path, or on localhost:port when a port is given, until cancelled'''
+        self._pending = asyncio.Semaphore(self.max_pending)
+        self._executor = concurrent.futures.ProcessPoolExecutor(max_workers=self.jobs)
+        try:
+            loop = asyncio.get_running_loop()
+            await asyncio.gather(*(loop.run_in_executor(self._executor, _warm_up) for _ in range(self.jobs)))
+            if port is not None:
+                server = await asyncio.start_server(self._handle_connection, "127.0.0.1", port)
+            else:
+                _remove_stale_socket(path)
+                server = await asyncio.start_unix_server(self._handle_connection, path)
+            async with server:
+                await server.serve_forever()
+        finally:
+            self._executor.shutdown()
+
+
+class Client:
+    '''
+    A connection to a Server, reused for all the conversions made with it. Failed conversions leave it usable; after a
+    refused request (too large), which makes the server close it, the next conversion reconnects.
+
+    :param address: the path of the server's unix socket, or a (host, port) tuple
+    '''
+    def __init__(self, address: typing.Union[str, typing.Tuple[str, int]] = DEFAULT_SOCKET):
+        self.address = address
+        self._socket: typing.Optional[socket.socket] = None
+        self._file = None
+        self._connect()
+
+    def _connect(self):
+        if isinstance(self.address, tuple):
+            self._socket = socket.create_connection(self.address)
+            self._socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        else:
+            self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self._socket.connect(self.address)
+        self._file = self._socket.makefile("rb")
+
+    def close(self):
+        if self._socket is not None:
+            self._file.close()
+            self._socket.close()
+            self._socket = self._file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def convert(self, contents: bytes, **options) -> bytes:
+        '''
+        :param contents: the ani file
+        :param options: see CONVERSION_OPTIONS and ANI_OPTIONS
+        :return: the gif
+        '''
+        encoded_options = json.dumps(options).encode() if options else b''
+        if self._socket is None:
+            self._connect()
+        try:
+            self._socket.sendall(REQUEST_HEADER.pack(len(encoded_options), len(contents)) + encoded_options + contents)
+        except (BrokenPipeError, ConnectionResetError):
+            # the server refused the request before reading all of it, its reply says why
+            pass
+        header = self._file.read(REPLY_HEADER.size)
+        if len(header) < REPLY_HEADER.size:
+            raise ConnectionError("the server closed the connection")
+        status, size = REPLY_HEADER.unpack(header)
+        data = self._file.read(size)
+        if status == REFUSED:
+            self.close()
+        if status != OK:
+            raise ServerError(data.decode(errors="replace"))
+        return data
+
+
+def convert_remote(contents: bytes, address=DEFAULT_SOCKET, **options) -> bytes:
+    '''a single conversion by the server at address, see Client'''
+    with Client(address) as client:
+        return client.convert(contents, **options)
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Convert ani files to gifs in a long running server.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    serve_parser = subparsers.add_parser("serve", help="run the server")
+    serve_parser.add_argument("--socket", default=DEFAULT_SOCKET, help="the path of the unix socket to listen on")
+    serve_parser.add_argument("--port", type=int, default=None, help="listen on this localhost port instead")
+    serve_parser.add_argument("-j", "--jobs", type=int, default=os.cpu_count(), help="the number of worker processes")
+    serve_parser.add_argument("--max-request-size", type=int, default=DEFAULT_MAX_REQUEST_SIZE >> 20,
+                              help="in MiB, larger requests are refused")
+    serve_parser.add_argument("--timeout", type=float, default=DEFAULT_TIMEOUT,
+                              help="seconds a conversion may take before failing")
+    serve_parser.add_argument("--max-pending", type=int, default=None,
+                              help="conversions queued at once, beyond which requests wait (twice --jobs by default)")
+    serve_parser.add_argument("--cache", metavar="DIRECTORY",
+                              help="reuse the gifs converted from the same file with the same options, kept in this "
+                                   "directory")
+    serve_parser.add_argument("--cache-size", type=int, default=DEFAULT_MAX_SIZE >> 20,
+                              help="the size the cache is trimmed to, in MiB")
+
+    convert_parser = subparsers.add_parser("convert", help="have the server convert a file")
+    convert_parser.add_argument("ani_file")
+    convert_parser.add_argument("output_file", help="'-' for standard output")
+    convert_parser.add_argument("--socket", default=DEFAULT_SOCKET, help="the path of the server's unix socket")
+    convert_parser.add_argument("--port", type=int, default=None, help="connect to this localhost port instead")
+    convert_parser.add_argument("--palette-samples", type=int, default=None,
+                                help="build the palette from about this many pixels rather than all of them")
+    convert_parser.add_argument("--delta", action='store_true', default=False,
+                                help="only encode the changing part of each frame")
+    convert_parser.add_argument("--collapse", action='store_true', default=False,
+                                help="show runs of identical frames as single longer frames")
+    convert_parser.add_argument("--lzw-mode", choices=lzw.MODES, default=None,
+                                help="fast: quickest but largest, greedy: dictionary compression, "
+                                     "auto: whichever suits each frame")
+    convert_parser.add_argument("--icon-size", type=int, default=None,
+                                help="for icons holding several images, use the one closest to this size")
+    convert_parser.add_argument("--icon-bpp", type=int, default=None,
+                                help="for icons holding several images, use the one closest to this bit depth")
+
+    args = parser.parse_args()
+
+    if args.command == "serve":
+        cache = ConversionCache(args.cache, args.cache_size << 20) if args.cache else None
+        server = Server(args.jobs, args.max_request_size << 20, args.timeout, args.max_pending, cache)
+        try:
+            asyncio.run(server.serve(args.socket, args.port))
+        except KeyboardInterrupt:
+            pass
+        except FileExistsError as e:
+            print(e, file=sys.stderr)
+            sys.exit(1)
+    else:
+        options = {name: value for name, value in (("palette_samples", args.palette_samples), ("delta", args.delta),
+                                                   ("lzw_mode", args.lzw_mode), ("collapse", args.collapse),
+                                                   ("icon_size", args.icon_size),
+                                                   ("icon_bits_per_pixel", args.icon_bpp)) if value}
+        with open(args.ani_file, "rb") as file:
+            contents = file.read()
+        address = ("127.0.0.1", args.port) if args.port is not None else args.socket
+        try:
+            gif = convert_remote(contents, address, **options)
+        except ServerError as e:
+            print(e, file=sys.stderr)
+            sys.exit(1)
+        if args.output_file == "-":
+            sys.stdout.buffer.write(gif)
+        else:
+            with open(args.output_file, "wb") as outfile:
+                outfile.write(gif)
@@ -0,0 +1,123 @@
+import collections
+import contextlib
+import contextvars
+import functools
+import json
+import time
+import tracemalloc
+import typing
+
+
+class Stats:
+    '''
+    What a conversion spent its time on and what it processed. Timers are cumulated seconds per stage, counters are
+    named totals (pixels decoded, palette cache hits and misses, lzw codes...).
+    '''
+    def __init__(self):
+        self.timers: typing.Dict[str, float] = collections.defaultdict(float)
+        self.counters: typing.Dict[str, int] = collections.Counter()
+        self.elapsed = 0.0
+        # in bytes, only when memory was traced
+        self.peak_memory: typing.Optional[int] = None
+
+    @property
+    def compression_ratio(self) -> typing.Optional[float]:
+        '''lzw input pixels (a byte each) per output byte'''
+        if not self.counters["lzw_output_bytes"]:
+            return None
+        return self.counters["lzw_input_pixels"] / self.counters["lzw_output_bytes"]
+
+    def as_dict(self):
+        return {"elapsed": self.elapsed, "timers": dict(self.timers), "counters": dict(self.counters),
+                "compression_ratio": self.compression_ratio, "peak_memory": self.peak_memory}
+
+    def to_json(self):
+        return json.dumps(self.as_dict(), indent=2)
+
+    def format_table(self):
+        lines = [f"{'elapsed':24}{self.elapsed * 1000:12.2f} ms"]
+        lines.extend(f"{name:24}{seconds * 1000:12.2f} ms" for name, seconds in self.timers.items())
+        lines.extend(f"{name:24}{count:12}" for name, count in self.counters.items())
+        if self.compression_ratio is not None:
+            lines.append(f"{'compression_ratio':24}{self.compression_ratio:12.2f}")
+        if self.peak_memory is not None:
+            lines.append(f"{'peak_memory':24}{self.peak_memory / 1024:12.1f} KiB")
+        return "\n".join(lines)
+
+
+# the stats being collected, None when instrumentation is off
+_current: contextvars.ContextVar[typing.Optional[Stats]] = contextvars.ContextVar("stats", default=None)
+
+
+def current() -> typing.Optional[Stats]:
+    return _current.get()
+
+
+@contextlib.contextmanager
+def collect(hook: typing.Callable[[Stats], None] = None, trace_memory=False) -> typing.Iterator[Stats]:
+    '''
+    Turns instrumentation on for the duration of the block, in this thread or task. Work done by worker processes
+    (make_gif with workers) is not accounted for.
+
+    :param hook: called with the stats when the block exits
+    :param trace_memory: also record the peak memory allocated by python during the block, which slows it down
+    '''
+    stats = Stats()
+    token = _current.set(stats)
+    started_tracing = trace_memory and not tracemalloc.is_tracing()
+    if started_tracing:
+        tracemalloc.start()
+    elif trace_memory:
+        tracemalloc.reset_peak()
+    start = time.perf_counter()
+    try:
+        yield stats
+    finally:
+        stats.elapsed = time.perf_counter() - start
+        if trace_memory:
+            stats.peak_memory = tracemalloc.get_traced_memory()[1]
+            if started_tracing:
+                tracemalloc.stop()
+        _current.reset(token)
+        if hook is not None:
+            hook(stats)
+
+
+def count(name, amount=1):
+    stats = _current.get()
+    if stats is not None:
+        stats.counters[name] += amount
+
+
+@contextlib.contextmanager
+def _timer(stats, name):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        stats.timers[name] += time.perf_counter() - start
+
+
+def timer(name) -> typing.ContextManager:
+    '''times the block under name, if instrumentation is on'''
+    stats = _current.get()
+    if stats is None:
+        return contextlib.nullcontext()
+    return _timer(stats, name)
+
+
+def timed(name):
+    '''decorator timing every call of the function under name, if instrumentation is on'''
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            stats = _current.get()
+            if stats is None:
+                return function(*args, **kwargs)
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                stats.timers[name] += time.perf_counter() - start
+        return wrapper
+    return decorator